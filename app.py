@@ -1,19 +1,42 @@
 # -*- coding: utf-8 -*-
 import streamlit as st
 import pandas as pd
+import numpy as np
 from datetime import date
-from supabase import create_client, Client
+from supabase import create_client, Client, ClientOptions
+from postgrest.exceptions import APIError
+from realtime import AsyncRealtimeClient
+import httpx
 import io
+import time
+import asyncio
+import codecs
+import hashlib
+import json
+import sqlite3
+import threading
+import queue
+import re
+import uuid
+import weakref
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 import streamlit.components.v1 as components
 import bcrypt
+import xlsxwriter
 
 # === ReportLab para gerar PDF robusto (cabeçalho + paginação) ===
 from reportlab.lib.pagesizes import A4
 from reportlab.lib import colors
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
+from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, PageBreak, Flowable
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.units import mm
 
+# Copy-on-Write: filtros e fatias do store são visões baratas e uma escrita
+# nunca vaza para outra visão (sempre ligado a partir do pandas 3)
+if int(pd.__version__.split('.')[0]) < 3:
+    pd.set_option('mode.copy_on_write', True)
+
 # ============================
 # CONFIGURAÇÃO DA PÁGINA (MOBILE) - 1ª chamada do Streamlit
 # ============================
@@ -192,10 +215,54 @@ input, select, textarea,
 # ============================
 # CONFIGURAÇÃO SUPABASE
 # ============================
+class TransporteComRetentativa(httpx.HTTPTransport):
+    """
+    Transporte HTTP/2 keep-alive que repete, com backoff, falhas de rede e 502/503/504.
+    POST só é repetido se a conexão nem chegou a abrir.
+    """
+    METODOS_IDEMPOTENTES = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE", "PATCH"}  # PATCH do app grava valores fixos
+    STATUS_TRANSITORIOS = {502, 503, 504}
+
+    def __init__(self, tentativas: int = 3, espera_base: float = 0.25, **kwargs):
+        super().__init__(http2=True, **kwargs)
+        self.tentativas = tentativas
+        self.espera_base = espera_base
+
+    def handle_request(self, request):
+        idempotente = request.method in self.METODOS_IDEMPOTENTES
+        tentativa = 0
+        while True:
+            try:
+                resposta = super().handle_request(request)
+                if not (idempotente and resposta.status_code in self.STATUS_TRANSITORIOS) or tentativa >= self.tentativas:
+                    return resposta
+                resposta.close()
+            except httpx.TransportError as erro:
+                nao_enviada = isinstance(erro, (httpx.ConnectError, httpx.ConnectTimeout))
+                if not (idempotente or nao_enviada) or tentativa >= self.tentativas:
+                    raise
+            time.sleep(self.espera_base * 2 ** tentativa)
+            tentativa += 1
+
+@st.cache_resource(show_spinner=False)
+def conectar_supabase(url: str, key: str) -> Client:
+    """
+    Client único por processo: criado uma vez (não a cada rerun) e compartilhado
+    pelas sessões, sobre um pool HTTP/2 com keep-alive e timeouts curtos.
+    """
+    http = httpx.Client(
+        transport=TransporteComRetentativa(
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10, keepalive_expiry=120),
+        ),
+        timeout=httpx.Timeout(15.0, connect=5.0),
+        follow_redirects=True,
+    )
+    return create_client(url, key, options=ClientOptions(httpx_client=http))
+
 try:
     url: str = st.secrets["SUPABASE_URL"]
     key: str = st.secrets["SUPABASE_KEY"]
-    supabase: Client = create_client(url, key)
+    supabase: Client = conectar_supabase(url, key)
 except Exception:
     st.error("Erro ao conectar ao banco de dados. Verifique os Secrets.")
     st.stop()
@@ -243,24 +310,53 @@ if st.sidebar.button("Sair"):
     st.session_state.logged_in = False
     st.rerun()
 
+# ============================
+# DINHEIRO EM CENTAVOS (int64)
+# ============================
+# Valores circulam no app como centavos inteiros: somas exatas (sem deriva de
+# float) e vetorizadas. Reais só existem na fronteira: banco, formulários e Excel.
+def para_centavos(valores):
+    """Reais (número/texto do banco ou de um formulário) -> centavos; aceita escalar ou Series (nulo = 0)."""
+    if isinstance(valores, pd.Series):
+        return (pd.to_numeric(valores, errors='coerce').fillna(0.0) * 100).round().astype('int64')
+    return int(round(float(valores or 0) * 100))
+
+def em_reais(centavos):
+    """Centavos -> reais, só para gravar no banco (numeric) ou no Excel."""
+    return centavos / 100
+
+def formatar_moeda(centavos, casas: int = 2, simbolo: bool = True, padrao_br: bool = False):
+    """Formata centavos (escalar ou Series) como 'R$ 1,234.56' ou, com padrao_br, 'R$ 1.234,56'."""
+    escalar = not isinstance(centavos, pd.Series)
+    c = pd.to_numeric(pd.Series([centavos] if escalar else centavos), errors='coerce').fillna(0).astype('int64')
+    inteiro = (c.abs() + 50) // 100 if casas == 0 else c.abs() // 100
+    milhar, decimal = ('.', ',') if padrao_br else (',', '.')
+    texto = inteiro.astype(str).str.replace(r'\B(?=(\d{3})+(?!\d))', milhar, regex=True)
+    if casas:
+        texto = texto + decimal + (c.abs() % 100).astype(str).str.zfill(2)
+    negativo = c.lt(0) & (inteiro.gt(0) if casas == 0 else True)
+    texto = negativo.map({True: '-', False: ''}) + texto
+    if simbolo:
+        texto = 'R$ ' + texto
+    return texto.iloc[0] if escalar else texto
+
 # ============================
 # FUNÇÕES DE BANCO DE DADOS
 # ============================
+# Dados de referência (pessoas, metas, fixos) mudam pouco: ficam num cache do
+# processo, compartilhado entre as sessões, com TTL e .clear() após cada escrita.
+# Todos são lidos da réplica local; pessoas é a cópia da view vw_pessoas_ativas.
+TTL_REFERENCIA = 600  # segundos
+
+@st.cache_data(ttl=TTL_REFERENCIA, show_spinner=False)
 def buscar_pessoas():
     """
-    Retorna lista de nomes de pessoas ativas (ordenadas), vindo da view vw_pessoas_ativas.
+    Retorna lista de nomes de pessoas ativas (na ordem da view vw_pessoas_ativas).
     Mantém 'Ambos' ao final. Fallback seguro para ['Guilherme','Alynne','Ambos'].
     """
-    try:
-        # Views são expostas pelo PostgREST como se fossem tabelas
-        res = supabase.table("vw_pessoas_ativas").select("*").execute()
-        if res.data:
-            nomes = [r.get('nome') for r in res.data if r.get('nome')]
-            nomes = [n for n in nomes if str(n).strip().lower() != 'ambos']
-            return nomes + ['Ambos']
-    except Exception:
-        pass
-    return ['Guilherme', 'Alynne', 'Ambos']
+    nomes = [r['nome'] for r in ler_replica(replica(), "SELECT nome FROM pessoas ORDER BY rowid")
+             if r['nome'] and str(r['nome']).strip().lower() != 'ambos']
+    return nomes + ['Ambos'] if nomes else ['Guilherme', 'Alynne', 'Ambos']
 
 def idx_pessoa(valor: str, pessoas: list[str]) -> int:
     try:
@@ -268,55 +364,1494 @@ def idx_pessoa(valor: str, pessoas: list[str]) -> int:
     except Exception:
         return pessoas.index('Ambos') if 'Ambos' in pessoas else 0
 
-def buscar_dados():
-    res = supabase.table("transacoes").select("*").execute()
-    df = pd.DataFrame(res.data)
-    colunas = ['id', 'data', 'descricao', 'valor', 'tipo', 'categoria', 'status', 'responsavel']
-    if df.empty:
-        return pd.DataFrame(columns=colunas)
+# Colunas de transacoes que o store usa (nada de select("*")); os tipos ficam
+# fixados já na carga. O cubo agrega direto na réplica, sem passar por aqui.
+COLUNAS_TRANSACOES = ['id', 'data', 'descricao', 'valor', 'tipo', 'categoria', 'status', 'responsavel']
+# No store, 'valor' (reais, como no banco) vira 'centavos' (int64)
+COLUNAS_STORE = ['centavos' if c == 'valor' else c for c in COLUNAS_TRANSACOES]
+TIPOS_TRANSACOES = {'id': 'int64', 'data': 'datetime64[ns]', 'descricao': 'str', 'centavos': 'int64'}
+PADROES_TRANSACOES = {'descricao': '', 'tipo': '', 'categoria': '', 'status': 'Pago', 'responsavel': 'Ambos'}
+
+CATEGORIAS = ["🛒 Mercado", "🏠 Moradia", "🚗 Transporte", "🍕 Lazer", "💡 Contas", "💰 Salário", "✨ Outros"]
+STATUS = ["Pago", "Pendente", "Em Negociação"]
+TIPOS = ["Saída", "Entrada"]
+COLUNAS_CATEGORICAS = ['tipo', 'categoria', 'status', 'responsavel']
+
+def vocabularios():
+    """Vocabulário fixo de cada coluna categórica do store."""
+    return {'tipo': TIPOS + [''], 'categoria': CATEGORIAS + [''], 'status': STATUS,
+            'responsavel': buscar_pessoas()}
+
+def categorizar(serie, vocab):
+    """Categorical com o vocabulário dado; valores fora dele (legado) entram no fim, sem perda."""
+    extras = sorted(set(serie.unique()) - set(vocab))
+    return serie.astype(pd.CategoricalDtype(list(vocab) + extras))
+
+def select_transacoes(*extras) -> str:
+    """Lista de colunas para o .select() de transacoes (mais extras, ex.: updated_at)."""
+    return ", ".join(COLUNAS_TRANSACOES + list(extras))
+
+def normalizar_transacoes(registros):
+    """Converte registros crus da tabela transacoes no DataFrame padrão do app, já tipado."""
+    df = pd.DataFrame(registros, columns=COLUNAS_TRANSACOES)
     df['data'] = pd.to_datetime(df['data'], errors='coerce')
-    if 'status' not in df.columns:
-        df['status'] = 'Pago'
-    df['status'] = df['status'].fillna('Pago').astype(str)
-    if 'responsavel' not in df.columns:
-        df['responsavel'] = 'Ambos'
-    df['responsavel'] = df['responsavel'].fillna('Ambos').astype(str)
-    for c in colunas:
-        if c not in df.columns:
-            df[c] = None
-    return df[colunas]
+    df['valor'] = para_centavos(df['valor'])
+    df = df.rename(columns={'valor': 'centavos'}).fillna(PADROES_TRANSACOES).astype(TIPOS_TRANSACOES)
+    for col, vocab in vocabularios().items():
+        df[col] = categorizar(df[col], vocab)
+    return df
 
+def concatenar_transacoes(partes):
+    """pd.concat que preserva as colunas categóricas; o resultado sai ordenado por data."""
+    partes = list(partes)
+    for col in COLUNAS_CATEGORICAS:
+        cats = partes[0][col].cat.categories
+        for p in partes[1:]:
+            if not p[col].cat.categories.equals(cats):
+                cats = cats.union(p[col].cat.categories, sort=False)
+        partes = [p if p[col].cat.categories.equals(cats) else p.assign(**{col: p[col].cat.set_categories(cats)})
+                  for p in partes]
+    return pd.concat(partes).sort_values('data', kind='stable', na_position='last', ignore_index=True)
+
+@st.cache_data(ttl=TTL_REFERENCIA, show_spinner=False)
 def buscar_metas():
-    res = supabase.table("metas").select("*").execute()
-    return {item['categoria']: item['limite'] for item in res.data} if res.data else {}
+    registros = ler_replica(replica(), "SELECT categoria, limite FROM metas")
+    return {item['categoria']: para_centavos(item['limite']) for item in registros}
 
+@st.cache_data(ttl=TTL_REFERENCIA, show_spinner=False)
 def buscar_fixos():
-    res = supabase.table("fixos").select("*").execute()
-    df = pd.DataFrame(res.data)
+    df = pd.DataFrame(ler_replica(replica(), "SELECT id, descricao, valor, categoria, responsavel FROM fixos"))
     if df.empty:
-        return pd.DataFrame(columns=['id', 'descricao', 'valor', 'categoria', 'responsavel'])
+        return pd.DataFrame(columns=['id', 'descricao', 'centavos', 'categoria', 'responsavel'])
+    df['valor'] = para_centavos(df['valor'])
+    df = df.rename(columns={'valor': 'centavos'})
     if 'responsavel' not in df.columns:
         df['responsavel'] = 'Ambos'
     df['responsavel'] = df['responsavel'].fillna('Ambos').astype(str)
     return df
 
+@st.cache_data(ttl=TTL_REFERENCIA, show_spinner=False)
+def buscar_regras():
+    """Regras de categorização, da mais antiga (maior prioridade) para a mais nova."""
+    return ler_replica(replica(), f"SELECT {', '.join(COLUNAS_REPLICA['regras_categoria'])} FROM regras_categoria ORDER BY id")
+
+# ============================
+# RÉPLICA LOCAL (SQLite em WAL + outbox)
+# ============================
+# Cópia local das tabelas do Supabase: as telas leem daqui e toda escrita entra
+# junto com uma entrada na outbox, que o motor de sincronização envia ao banco.
+ESQUEMA_REPLICA = """
+CREATE TABLE IF NOT EXISTS transacoes (
+    id INTEGER PRIMARY KEY, data TEXT, descricao TEXT, valor REAL, tipo TEXT,
+    categoria TEXT, status TEXT, responsavel TEXT, updated_at TEXT, chave_idempotencia TEXT
+);
+CREATE INDEX IF NOT EXISTS transacoes_data ON transacoes (data);
+CREATE TABLE IF NOT EXISTS fixos (
+    id INTEGER PRIMARY KEY, descricao TEXT, valor REAL, categoria TEXT, responsavel TEXT
+);
+CREATE TABLE IF NOT EXISTS metas (categoria TEXT PRIMARY KEY, limite REAL);
+CREATE TABLE IF NOT EXISTS pessoas (nome TEXT PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS regras_categoria (
+    id INTEGER PRIMARY KEY, padrao TEXT, regex INTEGER, categoria TEXT, valor_min REAL, valor_max REAL, responsavel TEXT
+);
+CREATE TABLE IF NOT EXISTS outbox (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT, tabela TEXT NOT NULL, op TEXT NOT NULL, payload TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS estado (chave TEXT PRIMARY KEY, valor TEXT);
+"""
+COLUNAS_REPLICA = {
+    'transacoes': ['id', 'data', 'descricao', 'valor', 'tipo', 'categoria', 'status', 'responsavel', 'updated_at',
+                   'chave_idempotencia'],
+    'fixos': ['id', 'descricao', 'valor', 'categoria', 'responsavel'],
+    'metas': ['categoria', 'limite'],
+    'pessoas': ['nome'],
+    'regras_categoria': ['id', 'padrao', 'regex', 'categoria', 'valor_min', 'valor_max', 'responsavel'],
+}
+CHAVE_REPLICA = {'transacoes': 'id', 'fixos': 'id', 'metas': 'categoria', 'pessoas': 'nome', 'regras_categoria': 'id'}
+ORIGEM_REPLICA = {'pessoas': 'vw_pessoas_ativas'}  # cópia de uma view: vem na carga das referências, sem Realtime
+
+@st.cache_resource
+def replica_local(caminho: str):
+    """
+    Réplica SQLite única do processo: escritas pela conexão compartilhada, sob o lock;
+    leituras numa conexão por thread.
+    """
+    con = sqlite3.connect(caminho, check_same_thread=False)
+    con.row_factory = sqlite3.Row
+    con.execute("PRAGMA journal_mode=WAL")
+    con.execute("PRAGMA synchronous=NORMAL")
+    con.executescript(ESQUEMA_REPLICA)
+    if 'chave_idempotencia' not in {c['name'] for c in con.execute("PRAGMA table_info(transacoes)")}:
+        con.execute("ALTER TABLE transacoes ADD COLUMN chave_idempotencia TEXT")  # réplica de versão anterior
+    con.execute("CREATE INDEX IF NOT EXISTS transacoes_chave ON transacoes (chave_idempotencia)")
+    rep = {'caminho': caminho, 'con': con, 'lock': threading.RLock(), 'leitura': threading.local(),
+           'pronta': threading.Event(), 'acordar': threading.Event(), 'pedidos': set(),
+           'online': None, 'ids_reais': {}, 'aguardando': {}, 'progresso': None, 'chave_no_servidor': None}
+    if con.execute("SELECT 1 FROM transacoes LIMIT 1").fetchone():
+        rep['pronta'].set()  # cópia de uma execução anterior: serve na hora e sincroniza depois
+    return rep
+
+def replica():
+    return replica_local(st.secrets.get("REPLICA_PATH", "financeiro_replica.db"))
+
+def marcadores(valores) -> str:
+    """'?, ?, ?' para um IN (...) com os valores dados."""
+    return ", ".join("?" * len(valores))
+
+def conexao_leitura(rep):
+    con = getattr(rep['leitura'], 'con', None)
+    if con is None:
+        con = rep['leitura'].con = sqlite3.connect(rep['caminho'], check_same_thread=False)
+        con.row_factory = sqlite3.Row
+    return con
+
+def ler_replica(rep, sql: str, params=()):
+    """SELECT na réplica; devolve dicts no mesmo formato das respostas do PostgREST."""
+    return [dict(r) for r in conexao_leitura(rep).execute(sql, list(params))]
+
+def ler_estado(con, chave: str):
+    linha = con.execute("SELECT valor FROM estado WHERE chave = ?", (chave,)).fetchone()
+    return json.loads(linha[0]) if linha else None
+
+def gravar_estado(con, chave: str, valor):
+    con.execute("INSERT OR REPLACE INTO estado (chave, valor) VALUES (?, ?)", (chave, json.dumps(valor)))
+
+def ids_pendentes(con, tabela: str) -> set:
+    """Chaves de linhas com escrita ainda na outbox (a versão local prevalece sobre a do banco)."""
+    chave = CHAVE_REPLICA[tabela]
+    pendentes = set()
+    for (payload,) in con.execute("SELECT payload FROM outbox WHERE tabela = ?", (tabela,)):
+        payload = json.loads(payload)
+        pendentes.update(payload.get('ids', []))
+        pendentes.update(r.get(chave) for r in payload.get('registros', []))
+    return pendentes
+
+def liberar_provisorios(rep, fila, provisorios):
+    """A sessão dona de 'fila' já aplicou essas confirmações e não cita mais os ids provisórios."""
+    with rep['lock']:
+        for p in provisorios:
+            rep['aguardando'].get(p, set()).discard(fila)
+    podar_ids_reais(rep)
+
+def podar_ids_reais(rep):
+    """Esquece as traduções que nenhuma sessão (viva) nem entrada da outbox ainda pode citar."""
+    with rep['lock']:
+        livres = [p for p, filas in rep['aguardando'].items() if not filas]
+        if not livres:
+            return
+        citados = set().union(*(ids_pendentes(rep['con'], t) for t in CHAVE_REPLICA))
+        for p in livres:
+            if p not in citados:
+                del rep['ids_reais'][p], rep['aguardando'][p]
+
+def aplicar_na_replica(con, tabela: str, op: str, payload: dict):
+    """Aplica nas tabelas da réplica uma escrita no formato da outbox (insert/upsert/update/delete)."""
+    chave, colunas = CHAVE_REPLICA[tabela], COLUNAS_REPLICA[tabela]
+    if op in ('insert', 'upsert'):
+        con.executemany(
+            f"INSERT OR REPLACE INTO {tabela} ({', '.join(colunas)}) VALUES ({marcadores(colunas)})",
+            [tuple(r.get(c) for c in colunas) for r in payload['registros']])
+        return
+    ids = list(payload['ids'])
+    if not ids:
+        return
+    if op == 'update':
+        campos = {c: v for c, v in payload['campos'].items() if c in colunas}
+        if campos:
+            con.execute(f"UPDATE {tabela} SET {', '.join(f'{c} = ?' for c in campos)} WHERE {chave} IN ({marcadores(ids)})",
+                        [*campos.values(), *ids])
+    else:
+        con.execute(f"DELETE FROM {tabela} WHERE {chave} IN ({marcadores(ids)})", ids)
+
+def registrar_escrita(tabela: str, op: str, **payload):
+    """Grava na réplica e na outbox numa só transação e acorda o motor de sincronização."""
+    gravar_escrita(replica(), feed_alteracoes(url, key), tabela, op, payload,
+                   exceto=st.session_state.get('fila_alteracoes'))
+
+def gravar_escrita(rep, feed, tabela: str, op: str, payload: dict, exceto=None):
+    """registrar_escrita sem depender de uma sessão (serve também ao motor); 'exceto' não recebe o eco."""
+    if tabela == 'transacoes' and op == 'insert':
+        # toda inserção leva chave: reenvio após timeout (POST gravado, resposta perdida) não duplica
+        payload['registros'] = [{'chave_idempotencia': str(uuid.uuid4()), **r} for r in payload['registros']]
+    with rep['lock'], rep['con'] as con:
+        if 'ids' in payload:  # sob o lock: confirmar_enviada não troca o id entre a tradução e a gravação
+            payload['ids'] = [rep['ids_reais'].get(i, i) for i in payload['ids']]
+        aplicar_na_replica(con, tabela, op, payload)
+        con.execute("INSERT INTO outbox (tabela, op, payload) VALUES (?, ?, ?)", (tabela, op, json.dumps(payload)))
+        if op == 'update':
+            linhas = [dict(r) for r in con.execute(
+                f"SELECT * FROM {tabela} WHERE id IN ({marcadores(payload['ids'])})", payload['ids'])]
+    rep['acordar'].set()
+    if tabela != 'transacoes':
+        return
+    if op == 'delete':
+        eventos = [{'tipo': 'DELETE', 'antigo': {'id': i}} for i in payload['ids']]
+    else:
+        eventos = [{'tipo': 'UPSERT', 'registro': r} for r in (linhas if op == 'update' else payload['registros'])]
+    for evento in eventos:
+        feed['publicar'](evento, exceto=exceto)
+
+# ============================
+# SINCRONIZAÇÃO INCREMENTAL (delta)
+# ============================
+def calcular_marca(registros, marca=None):
+    """
+    Atualiza a marca d'água (high-water mark) com os registros recebidos.
+    Usa 'updated_at' quando a tabela tiver a coluna; senão, o maior 'id'.
+    """
+    marca = dict(marca or {'updated_at': None, 'id': None})
+    for r in registros or []:
+        upd = r.get('updated_at')
+        if upd and (marca['updated_at'] is None or str(upd) > marca['updated_at']):
+            marca['updated_at'] = str(upd)
+        try:
+            rid = int(r.get('id'))
+        except (TypeError, ValueError):
+            continue
+        if marca['id'] is None or rid > marca['id']:
+            marca['id'] = rid
+    return marca
+
+def buscar_marca_servidor(pool=None):
+    """
+    Marca d'água atual do banco (maior updated_at / maior id), em consultas de
+    1 linha. Com um pool, as duas consultas saem em paralelo.
+    """
+    if pool is None:
+        return {'updated_at': buscar_updated_at_max(), 'id': buscar_id_max()}
+    f_upd, f_id = pool.submit(buscar_updated_at_max), pool.submit(buscar_id_max)
+    return {'updated_at': f_upd.result(), 'id': f_id.result()}
+
+def buscar_updated_at_max():
+    try:
+        res = supabase.table("transacoes").select("updated_at").order("updated_at", desc=True).limit(1).execute()
+        if res.data and res.data[0].get('updated_at'):
+            return str(res.data[0]['updated_at'])
+    except Exception:
+        pass  # tabela sem coluna updated_at: usa só o id
+    return None
+
+def chave_no_servidor(rep) -> bool:
+    """Se transacoes no banco já tem chave_idempotencia (sql/chave_idempotencia.sql); testa uma vez por processo."""
+    if rep['chave_no_servidor'] is None:
+        try:
+            supabase.table("transacoes").select("chave_idempotencia").limit(1).execute()
+            rep['chave_no_servidor'] = True
+        except APIError:
+            rep['chave_no_servidor'] = False  # sem a migração: lança sem chave, dedupe só na réplica
+    return rep['chave_no_servidor']
+
+def buscar_id_max():
+    try:
+        res = supabase.table("transacoes").select("id").order("id", desc=True).limit(1).execute()
+        if res.data:
+            return int(res.data[0]['id'])
+    except Exception:
+        pass
+    return None
+
+def mesclar_dados(df_delta, alterou_banco: bool = True):
+    """Substitui/inclui no store local as linhas recebidas (chave: id)."""
+    if df_delta is None or df_delta.empty:
+        return
+    atual = st.session_state.dados
+    ja_no_store = atual['id'].isin(df_delta['id'])
+    if alterou_banco:
+        registrar_no_cubo(atual[ja_no_store], df_delta)
+    st.session_state.dados = concatenar_transacoes([atual[~ja_no_store], df_delta])
+
+def atualizar_local(ids, campos: dict):
+    """Aplica no store local uma alteração já enviada ao banco (novo snapshot, sem alterar no lugar)."""
+    df = st.session_state.dados.copy(deep=False)
+    mask = df['id'].isin(list(ids))
+    antigas = df[mask]
+    for col, val in campos.items():
+        if isinstance(df[col].dtype, pd.CategoricalDtype) and val not in df[col].cat.categories:
+            df[col] = df[col].cat.add_categories([val])
+        df.loc[mask, col] = val
+    registrar_no_cubo(antigas, df[mask])
+    # alteração de data reordena o índice por data
+    st.session_state.dados = concatenar_transacoes([df]) if 'data' in campos else df
+
+def remover_local(ids):
+    """Remove do store local linhas excluídas (aqui ou no banco)."""
+    df = st.session_state.dados
+    mask = df['id'].isin(list(ids))
+    registrar_no_cubo(df[mask], None)
+    st.session_state.dados = df[~mask].reset_index(drop=True)
+
+def zerar_store():
+    """Store vazio; janelas e cubo voltam a ser lidos (o cubo, da réplica ou das RPCs)."""
+    st.session_state.dados = normalizar_transacoes([])
+    st.session_state.janelas = set()
+    st.session_state.pop('cubo', None)
+    st.session_state.pop('metricas_do_banco', None)
+
+
+# ============================
+# JANELAS DE CONSULTA (filtros na réplica)
+# ============================
+def consultar_janela(rep, filtro):
+    """Registros crus de uma janela, lidos da réplica (pode rodar fora da thread do script)."""
+    where, params = filtro
+    return ler_replica(rep, f"SELECT {select_transacoes()} FROM transacoes WHERE {where}", params)
+
+def carregar_janela(chave, filtro):
+    """
+    Lê da réplica só as linhas de uma janela (ex.: um mês) e mescla no store.
+    Cada janela é lida uma vez; depois os eventos do feed a mantêm atualizada.
+    """
+    if chave in st.session_state.janelas:
+        return
+    mesclar_dados(normalizar_transacoes(consultar_janela(replica(), filtro)), alterou_banco=False)
+    st.session_state.janelas.add(chave)
+
+def limites_mes(ano: int, mes: int):
+    """Intervalo [início, fim) do mês, para predicados >= / < em 'data'."""
+    inicio = date(ano, mes, 1)
+    fim = date(ano + 1, 1, 1) if mes == 12 else date(ano, mes + 1, 1)
+    return inicio, fim
+
+def fatia_por_data(df, inicio=None, fim=None):
+    """Linhas com inicio <= data < fim de um frame ordenado por data (busca binária)."""
+    datas = df['data']
+    i = 0 if inicio is None else int(datas.searchsorted(pd.Timestamp(inicio), side='left'))
+    j = len(df) if fim is None else int(datas.searchsorted(pd.Timestamp(fim), side='left'))
+    return df.iloc[i:j]
+
+def janela_mes(ano: int, mes: int):
+    inicio, fim = limites_mes(ano, mes)
+    return ('mes', ano, mes), ("data >= ? AND data < ?", (str(inicio), str(fim)))
+
+def janela_pendentes():
+    """Saídas pendentes de qualquer data (base da lista de atrasados)."""
+    return ('pendentes',), ("status = ? AND tipo = ?", ("Pendente", "Saída"))
+
+def janela_negociacao():
+    return ('negociacao',), ("status = ?", ("Em Negociação",))
+
+def carregar_mes(ano: int, mes: int):
+    carregar_janela(*janela_mes(ano, mes))
+
+def carregar_pendentes():
+    carregar_janela(*janela_pendentes())
+
+def carregar_negociacao():
+    carregar_janela(*janela_negociacao())
+
+# ============================
+# CUBO DE AGREGADOS (ano, mês, categoria, tipo, status, responsável)
+# ============================
+CHAVES_CUBO = ['ano', 'mes', 'categoria', 'tipo', 'status', 'responsavel']
+
+def agrupar_cubo(df):
+    """
+    Agrupa linhas com as colunas data/categoria/tipo/status/responsavel/soma/qtd
+    nas chaves do cubo. Serve tanto para linhas cruas quanto para parciais por dia.
+    """
+    if df is None or df.empty:
+        return pd.DataFrame(columns=['soma', 'qtd'],
+                            index=pd.MultiIndex.from_tuples([], names=CHAVES_CUBO))
+    datas = pd.to_datetime(df['data'], errors='coerce')
+    base = pd.DataFrame({
+        'ano': datas.dt.year.fillna(0).astype(int),
+        'mes': datas.dt.month.fillna(0).astype(int),
+        'categoria': df['categoria'].fillna('').astype(str),
+        'tipo': df['tipo'].fillna('').astype(str),
+        'status': df['status'].fillna('Pago').astype(str),
+        'responsavel': df['responsavel'].fillna('Ambos').astype(str),
+        'soma': pd.to_numeric(df['soma'], errors='coerce').fillna(0).astype('int64'),
+        'qtd': pd.to_numeric(df['qtd'], errors='coerce').fillna(0).astype(int),
+    })
+    return base.groupby(CHAVES_CUBO)[['soma', 'qtd']].sum()
+
+def consultar_cubo(rep):
+    """Cubo do histórico inteiro da réplica (somas por dia em centavos) e o maior id coberto."""
+    colunas = ", ".join(['data'] + CHAVES_CUBO[2:])  # ano/mês saem da data
+    return montar_cubo(ler_replica(rep, f"""
+        SELECT {colunas}, SUM(CAST(ROUND(valor * 100) AS INTEGER)) AS soma, COUNT(*) AS qtd, MAX(id) AS id_max
+        FROM transacoes GROUP BY {colunas}"""))
+
+def montar_cubo(parciais):
+    """Cubo e maior id coberto a partir de parciais (data, chaves, soma, qtd, id_max), da réplica ou do banco."""
+    parciais = pd.DataFrame(parciais)
+    ids = pd.to_numeric(parciais['id_max'], errors='coerce') if 'id_max' in parciais.columns else pd.Series(dtype=float)
+    id_max = int(ids.max()) if ids.notna().any() else None
+    return agrupar_cubo(parciais), id_max
+
+def semear_cubo():
+    """Cubo da sessão, da réplica; enquanto ela baixa o histórico, de resumo_mensal() no banco."""
+    rep = replica()
+    parciais = chamar_rpc("resumo_mensal") if historico_baixando(rep) else None
+    st.session_state.metricas_do_banco = parciais is not None
+    st.session_state.cubo, st.session_state.cubo_id_max = consultar_cubo(rep) if parciais is None else montar_cubo(parciais)
+
+def registrar_no_cubo(antigas, novas):
+    """Atualiza o cubo tirando as versões antigas das linhas e somando as novas."""
+    cubo = st.session_state.get('cubo')
+    if cubo is None:
+        return
+    novas = novas if novas is not None else pd.DataFrame(columns=COLUNAS_STORE)
+    antigas = antigas if antigas is not None else pd.DataFrame(columns=COLUNAS_STORE)
+    sem_anterior = novas[~novas['id'].isin(antigas['id'])]
+    id_max = st.session_state.get('cubo_id_max')
+    if id_max is not None and not sem_anterior.empty:
+        # ids negativos são provisórios (inserção otimista): sempre linhas novas
+        ids_num = pd.to_numeric(sem_anterior['id'], errors='coerce').fillna(0)
+        if ids_num.between(1, id_max).any():
+            st.session_state.pop('cubo', None)
+            return
+    retirar = antigas.assign(soma=-antigas['centavos'], qtd=-1)
+    somar = novas.assign(soma=novas['centavos'], qtd=1)
+    partes = [p for p in (cubo, agrupar_cubo(retirar), agrupar_cubo(somar)) if not p.empty]
+    if partes:
+        cubo = pd.concat(partes).groupby(level=CHAVES_CUBO).sum()
+    st.session_state.cubo = cubo[cubo['qtd'] != 0]
+
+def soma_cubo(**filtros) -> int:
+    """Soma exata, em centavos, do cubo para os filtros dados (ex.: tipo='Entrada', ano=2025)."""
+    cubo = st.session_state.cubo
+    if cubo.empty:
+        return 0
+    mask = pd.Series(True, index=cubo.index)
+    for chave, valor in filtros.items():
+        mask &= cubo.index.get_level_values(chave) == valor
+    return int(cubo.loc[mask.values, 'soma'].sum())
+
+def gastos_por_categoria(ano: int, mes: int):
+    """Saídas pagas do mês por categoria, em centavos (base do 'Status das Metas')."""
+    cubo = st.session_state.cubo
+    if cubo.empty:
+        return pd.Series(dtype='int64')
+    idx = cubo.index
+    mask = (
+        (idx.get_level_values('ano') == ano) & (idx.get_level_values('mes') == mes) &
+        (idx.get_level_values('tipo') == 'Saída') & (idx.get_level_values('status') == 'Pago')
+    )
+    return cubo.loc[mask, 'soma'].groupby(level='categoria').sum()
+
+def totais_negociacao_cubo(responsavel=None, ano=None, mes=None):
+    """Soma e quantidade em negociação por responsável, do cubo (maior soma primeiro)."""
+    cubo = st.session_state.cubo
+    idx = cubo.index
+    mask = idx.get_level_values('status') == 'Em Negociação'
+    if responsavel is not None:
+        mask &= idx.get_level_values('responsavel') == responsavel
+    if ano is not None:
+        mask &= (idx.get_level_values('ano') == ano) & (idx.get_level_values('mes') == mes)
+    por_pessoa = cubo.loc[mask].groupby(level='responsavel')[['soma', 'qtd']].sum()
+    return por_pessoa[por_pessoa['qtd'] != 0].sort_values('soma', ascending=False)
+
+# ============================
+# MÉTRICAS NO BANCO (RPCs de sql/metricas.sql)
+# ============================
+# Na 1ª execução a réplica ainda está vazia: enquanto ela baixa o histórico, as
+# telas mostram números calculados no Postgres (poucas linhas por tela) em vez
+# de esperar a carga inteira.
+def historico_baixando(rep) -> bool:
+    """Réplica sem o histórico e a 1ª carga em andamento (o banco está respondendo)."""
+    return rep['progresso'] is not None and not rep['pronta'].is_set()
+
+def chamar_rpc(funcao: str, **params):
+    """supabase.rpc com parâmetros nomeados; None se a função não existir ou o banco não responder."""
+    try:
+        return supabase.rpc(funcao, params).execute().data or []
+    except Exception:
+        return None
+
+def atrasados_no_banco(antes: date):
+    """contas_atrasadas(p_antes) no formato do store, sem as linhas com escrita ainda na outbox."""
+    df = normalizar_transacoes(chamar_rpc("contas_atrasadas", p_antes=str(antes)) or [])
+    return df[~df['id'].isin(ids_pendentes(conexao_leitura(replica()), 'transacoes'))]
+
+def totais_negociacao(responsavel=None, ano=None, mes=None):
+    """totais_negociacao_cubo; enquanto o histórico baixa, de negociacao_por_responsavel() no banco."""
+    if not st.session_state.get('metricas_do_banco'):
+        return totais_negociacao_cubo(responsavel, ano, mes)
+    inicio, fim = limites_mes(ano, mes) if ano is not None else (None, None)
+    por_pessoa = pd.DataFrame(chamar_rpc("negociacao_por_responsavel", p_inicio=inicio and str(inicio),
+                                         p_fim=fim and str(fim)) or [], columns=['responsavel', 'soma', 'qtd'])
+    if responsavel is not None:
+        por_pessoa = por_pessoa[por_pessoa['responsavel'] == responsavel]
+    return por_pessoa.set_index('responsavel').astype('int64').sort_values('soma', ascending=False)
+
+# ============================
+# MUTAÇÕES OTIMISTAS (réplica local + outbox)
+# ============================
+def novo_id_provisorio() -> int:
+    """Id negativo de uma linha criada aqui; o motor o troca pelo id do banco ao enviar."""
+    return -(uuid.uuid4().int % 10**12) - 1
+
+def atualizar_em_lote(ids, campos: dict):
+    """
+    Aplica a alteração no store local e na réplica na hora; a outbox leva um
+    único UPDATE ... WHERE id IN (...) ao Supabase.
+    """
+    ids = [int(i) for i in ids]
+    if not ids:
+        return
+    atualizar_local(ids, campos)
+    registrar_escrita('transacoes', 'update', ids=ids, campos=campos)
+
+def excluir_em_lote(ids):
+    """Remove do store local e da réplica na hora; a outbox leva um único DELETE ... WHERE id IN (...)."""
+    ids = [int(i) for i in ids]
+    if not ids:
+        return
+    remover_local(ids)
+    registrar_escrita('transacoes', 'delete', ids=ids)
+
+def inserir_transacao(registro: dict):
+    """Mostra o lançamento na hora (id provisório negativo) e o deixa na outbox para inserir."""
+    registro = {**registro, 'id': novo_id_provisorio()}
+    mesclar_dados(normalizar_transacoes([registro]))
+    registrar_escrita('transacoes', 'insert', registros=[registro])
+
+def confirmar_insercoes(reais: dict):
+    """
+    Troca ids provisórios pelos do banco ({provisório: real}) de uma vez só,
+    ou descarta a cópia provisória se o feed já trouxe a linha com o id real.
+    """
+    ja_no_store = set(st.session_state.dados['id'][st.session_state.dados['id'].isin(list(reais.values()))])
+    repetidos = [p for p, r in reais.items() if r in ja_no_store]
+    if repetidos:
+        remover_local(repetidos)
+    df = st.session_state.dados.copy(deep=False)
+    trocar = df['id'].isin(list(reais))
+    if trocar.any():
+        df.loc[trocar, 'id'] = df.loc[trocar, 'id'].map(reais)
+        st.session_state.dados = df
+
+def status_sincronizacao():
+    """Aviso discreto de recarga em andamento, escritas ainda na outbox e operação sem conexão."""
+    rep = replica()
+    progresso = rep['progresso']
+    if progresso and progresso['total']:
+        st.caption(f"⬇️ Recarregando o histórico: {progresso['carregadas']} de {progresso['total']} lançamentos…")
+    pendentes = ler_replica(rep, "SELECT COUNT(*) AS n FROM outbox")[0]['n']
+    if rep['online'] is False:
+        st.caption("📴 Sem conexão com o banco: mostrando a cópia local"
+                   + (f" • {pendentes} alteração(ões) aguardando envio" if pendentes else ""))
+    elif pendentes:
+        st.caption(f"⏳ Enviando {pendentes} alteração(ões)…")
+
+# ============================
+# ALTERAÇÕES EM TEMPO REAL (Realtime -> réplica -> store da sessão)
+# ============================
+INTERVALO_ALTERACOES = 2.0  # segundos entre checagens da fila local (sem rede)
+
+@st.cache_resource
+def feed_alteracoes(url: str, key: str):
+    """Feed do processo: repassa às filas das sessões as alterações de transacoes e os avisos do motor."""
+    rep = replica()
+    feed = {'assinantes': weakref.WeakSet(), 'lock': threading.Lock(), 'conectado': False}
+    def publicar(evento, exceto=None):
+        with feed['lock']:
+            assinantes = list(feed['assinantes'])
+        for fila in assinantes:
+            if fila is not exceto:
+                fila.put(evento)
+    feed['publicar'] = publicar
+    threading.Thread(target=lambda: asyncio.run(ouvir_realtime(url, key, feed, rep)),
+                     name="realtime-transacoes", daemon=True).start()
+    return feed
+
+async def ouvir_realtime(url: str, key: str, feed, rep):
+    """Mantém a assinatura Realtime das tabelas replicadas, recriando o cliente se ele desistir."""
+    def ao_alterar(payload):
+        dados = payload.get('data', payload)
+        tabela = dados.get('table', 'transacoes')
+        if tabela not in CHAVE_REPLICA:
+            return
+        if dados.get('type') == 'DELETE':
+            antigo = dados.get('old_record') or {}
+            aplicar_do_servidor(rep, feed, tabela, excluidos=[antigo.get(CHAVE_REPLICA[tabela])])
+        elif dados.get('record'):
+            aplicar_do_servidor(rep, feed, tabela, [dados['record']])
+    while True:
+        cliente = AsyncRealtimeClient(f"{url}/realtime/v1", key, auto_reconnect=True)
+        try:
+            await cliente.connect()
+            canal = cliente.channel("transacoes-app")
+            for tabela in CHAVE_REPLICA.keys() - ORIGEM_REPLICA.keys():
+                canal.on_postgres_changes("*", schema="public", table=tabela, callback=ao_alterar)
+            await canal.subscribe()
+            desconectado_desde = 0.0  # 0 = acabou de (re)conectar
+            while True:
+                if cliente.is_connected:
+                    if desconectado_desde is not None:
+                        feed['conectado'] = True
+                        pedir_sincronizacao(rep, 'delta', 'conferir', 'referencias')
+                    desconectado_desde = None
+                elif desconectado_desde is None:
+                    feed['conectado'] = False
+                    desconectado_desde = time.monotonic()
+                elif time.monotonic() - desconectado_desde > 60:
+                    break
+                await asyncio.sleep(INTERVALO_ALTERACOES)
+        except Exception:
+            pass  # Realtime indisponível: o motor cobre com o delta periódico
+        feed['conectado'] = False
+        try:
+            await cliente.close()
+        except Exception:
+            pass
+        await asyncio.sleep(30)
+
+def assinar_alteracoes():
+    """Inscreve a sessão no feed do processo (uma fila por sessão)."""
+    if 'fila_alteracoes' in st.session_state:
+        return
+    feed = feed_alteracoes(url, key)
+    fila = queue.Queue()
+    with feed['lock']:
+        feed['assinantes'].add(fila)
+    st.session_state.fila_alteracoes = fila
+
+def aplicar_alteracoes():
+    """Aplica no store, em lote, os eventos recebidos desde o último rerun."""
+    fila = st.session_state.get('fila_alteracoes')
+    if fila is None:
+        return
+    eventos = []
+    while True:
+        try:
+            eventos.append(fila.get_nowait())
+        except queue.Empty:
+            break
+    for evento in eventos:
+        if evento['tipo'] == 'AVISO':
+            st.toast(f"⚠️ {evento['texto']}")
+        elif evento['tipo'] == 'RECARREGAR':
+            st.session_state.pop('dados', None)
+    vistos = [e['provisorio'] for e in eventos if e['tipo'] == 'ID_CONFIRMADO']
+    if 'dados' not in st.session_state:
+        liberar_provisorios(replica(), fila, vistos)
+        return  # a carga a seguir lê a réplica, que já tem tudo isso
+    upserts, confirmados = {}, {}
+    for evento in eventos:
+        if evento['tipo'] == 'ID_CONFIRMADO' and evento['tabela'] == 'transacoes':
+            upserts.pop(evento['provisorio'], None)
+            upserts[evento['registro']['id']] = evento['registro']
+            confirmados[evento['provisorio']] = evento['registro']['id']
+        elif evento['tipo'] == 'DELETE':
+            rid = (evento.get('antigo') or {}).get('id')
+            if rid is None:
+                continue
+            upserts.pop(rid, None)
+            if confirmados:  # a linha pode estar no store ainda com o id provisório
+                confirmar_insercoes(confirmados)
+                confirmados = {}
+            if not st.session_state.dados['id'].eq(rid).any():
+                st.session_state.pop('cubo', None)
+            remover_local([rid])
+        elif evento['tipo'] == 'UPSERT':
+            upserts[evento['registro']['id']] = evento['registro']
+    if confirmados:
+        confirmar_insercoes(confirmados)
+    if upserts:
+        mesclar_dados(normalizar_transacoes(list(upserts.values())))
+    liberar_provisorios(replica(), fila, vistos)
+
+def acompanhar_alteracoes():
+    """Checa a fila local da sessão e dispara um rerun quando chegam alterações ou o histórico acaba de baixar."""
+    @st.fragment(run_every=INTERVALO_ALTERACOES)
+    def _checar():
+        fila = st.session_state.get('fila_alteracoes')
+        if fila is not None and not fila.empty():
+            st.rerun()
+        if st.session_state.get('metricas_do_banco') and not historico_baixando(replica()):
+            st.session_state.pop('dados', None)  # histórico baixado: recarrega da réplica
+            st.rerun()
+
+    _checar()
+
+# ============================
+# MOTOR DE SINCRONIZAÇÃO (réplica <-> Supabase)
+# ============================
+INTERVALO_SINCRONIZACAO = 30  # segundos entre ciclos quando nada acorda o motor antes
+ESPERA_REPLICA = 15           # segundos até a 1ª sessão desistir de esperar o motor alcançar o banco
+ERROS_DE_REDE = (httpx.TransportError, OSError)  # sem conexão: tenta de novo no próximo ciclo
+STATUS_REPETIVEIS = {401, 408, 429}  # token vencido, timeout, limite de taxa: não são recusa
+COLUNAS_REFERENCIA = {
+    'fixos': "id, descricao, valor, categoria, responsavel",
+    'metas': "categoria, limite",
+    'pessoas': "nome",
+    'regras_categoria': "id, padrao, regex, categoria, valor_min, valor_max, responsavel",
+}
+REFERENCIAS_OPCIONAIS = {'pessoas', 'regras_categoria'}  # sem a tabela/view no banco: vazia
+
+@st.cache_resource
+def motor_sincronizacao(url: str, key: str):
+    """Inicia a thread única do processo que mantém réplica e Supabase em acordo."""
+    rep = replica()
+    feed = feed_alteracoes(url, key)
+    if rep['pronta'].is_set():
+        pedir_sincronizacao(rep, 'delta', 'conferir', 'referencias')
+    else:
+        pedir_sincronizacao(rep, 'completa', 'referencias')
+    lancar_automatico = bool(st.secrets.get("LANCAR_FIXOS_AUTOMATICO", False))
+    threading.Thread(target=ciclo_sincronizacao, args=(rep, feed, lancar_automatico),
+                     name="sincronizacao-replica", daemon=True).start()
+    return rep
+
+def pedir_sincronizacao(rep, *pedidos):
+    """Agenda trabalho para o motor ('completa', 'delta', 'conferir', 'referencias') e o acorda."""
+    with rep['lock']:
+        rep['pedidos'].update(pedidos)
+    rep['acordar'].set()
+
+def ciclo_sincronizacao(rep, feed, lancar_automatico: bool = False):
+    """Laço do motor: envia a outbox e traz do banco o que os pedidos pedirem."""
+    acordado = True
+    while True:
+        rep['acordar'].clear()
+        with rep['lock']:
+            pedidos, rep['pedidos'] = rep['pedidos'], set()
+        if not acordado and not feed['conectado']:
+            pedidos |= {'delta', 'conferir', 'referencias'}
+        online = True
+        try:
+            enviar_outbox(rep, feed)
+            podar_ids_reais(rep)  # sessões encerradas saem de 'aguardando' sozinhas
+            if 'completa' in pedidos:
+                puxar_tudo(rep, feed)
+            elif 'delta' in pedidos:
+                puxar_delta(rep, feed)
+            if 'conferir' in pedidos:
+                conferir_replica(rep, feed)
+            if 'referencias' in pedidos:
+                puxar_referencias(rep)
+            if lancar_automatico:
+                lancar_fixos_agendado(rep, feed)
+        except Exception as erro:
+            online = not isinstance(erro, ERROS_DE_REDE)
+            with rep['lock']:
+                rep['pedidos'] |= pedidos
+        if online != rep['online']:
+            rep['online'] = online
+            feed['publicar']({'tipo': 'SINCRONIZACAO'})
+        rep['pronta'].set()
+        acordado = rep['acordar'].wait(INTERVALO_SINCRONIZACAO)
+
+def enviar_ao_servidor(rep, tabela: str, op: str, payload: dict):
+    """Executa uma entrada da outbox no Supabase e devolve as linhas afetadas."""
+    consulta = supabase.table(tabela)
+    chave = CHAVE_REPLICA[tabela]
+    if op == 'insert':
+        por_chave = tabela == 'transacoes' and chave_no_servidor(rep)
+        fora = ('id', 'updated_at') if por_chave else ('id', 'updated_at', 'chave_idempotencia')
+        registros = [{c: v for c, v in r.items() if c not in fora} for r in payload['registros']]
+        if por_chave and any(r.get('chave_idempotencia') for r in registros):
+            # repetidas (mesma chave já no banco) são ignoradas e não voltam na resposta
+            return consulta.upsert(registros, on_conflict='chave_idempotencia', ignore_duplicates=True).execute().data
+        return consulta.insert(registros).execute().data
+    if op == 'upsert':
+        return consulta.upsert(payload['registros']).execute().data
+    if op == 'update':
+        return consulta.update(payload['campos']).in_(chave, payload['ids']).execute().data
+    return consulta.delete().in_(chave, payload['ids']).execute().data
+
+def recusada_pelo_banco(erro) -> bool:
+    """Se o erro é recusa definitiva do banco (4xx, dados ou permissão); o resto fica na fila."""
+    if not isinstance(erro, APIError):
+        return False
+    codigo = str(erro.code or '')
+    if codigo.isdigit() and len(codigo) == 3:  # resposta sem corpo JSON: o código é o status HTTP
+        return 400 <= int(codigo) < 500 and int(codigo) not in STATUS_REPETIVEIS
+    if codigo.startswith('PGRST'):
+        return codigo[5:6] in ('1', '2')  # PGRST1xx/2xx: requisição inválida; 0xx conexão, 3xx JWT
+    return codigo[:2] in ('22', '23', '42') or codigo == 'P0001'
+
+def enviar_outbox(rep, feed):
+    """Envia a outbox em ordem; recusa do banco desfaz a entrada, outros erros param o envio."""
+    enviou = False
+    while True:
+        linha = conexao_leitura(rep).execute(
+            "SELECT seq, tabela, op, payload FROM outbox ORDER BY seq LIMIT 1").fetchone()
+        if linha is None:
+            break
+        seq, tabela, op, payload = linha['seq'], linha['tabela'], linha['op'], json.loads(linha['payload'])
+        try:
+            resposta = enviar_ao_servidor(rep, tabela, op, payload)
+        except Exception as erro:
+            if not recusada_pelo_banco(erro):
+                raise
+            desfazer_recusada(rep, feed, seq, tabela, op, payload, erro)
+        else:
+            confirmar_enviada(rep, feed, seq, tabela, op, payload, resposta)
+        enviou = True
+    if enviou:
+        feed['publicar']({'tipo': 'SINCRONIZACAO'})
+
+def trocar_id(con, tabela: str, provisorio: int, real: int):
+    """Id provisório -> id do banco na réplica e nas entradas da outbox que ainda o citam."""
+    con.execute(f"DELETE FROM {tabela} WHERE id = ?", (real,))  # o Realtime pode ter trazido a linha antes
+    con.execute(f"UPDATE {tabela} SET id = ? WHERE id = ?", (real, provisorio))
+    for seq, payload in con.execute("SELECT seq, payload FROM outbox WHERE tabela = ?", (tabela,)).fetchall():
+        payload = json.loads(payload)
+        if provisorio in payload.get('ids', []):
+            payload['ids'] = [real if i == provisorio else i for i in payload['ids']]
+            con.execute("UPDATE outbox SET payload = ? WHERE seq = ?", (json.dumps(payload), seq))
+
+def parear_insercao(registros, resposta, por_chave: bool):
+    """Pares (enviado, devolvido) de uma inserção; com chave, as repetidas ficam com None."""
+    if not (por_chave and any(r.get('chave_idempotencia') for r in registros)):
+        return list(zip(registros, resposta or []))
+    devolvidos = {r.get('chave_idempotencia'): r for r in resposta or []}
+    return [(r, devolvidos.get(r.get('chave_idempotencia'))) for r in registros]
+
+def confirmar_enviada(rep, feed, seq, tabela, op, payload, resposta):
+    """Tira a entrada da outbox e leva para a réplica o que o banco devolveu."""
+    eventos, sumidos, repetidos = [], [], []
+    with feed['lock']:
+        sessoes = list(feed['assinantes'])  # quem pode ter o id provisório no store ou na tela
+    with rep['lock'], rep['con'] as con:
+        con.execute("DELETE FROM outbox WHERE seq = ?", (seq,))
+        if op == 'insert':
+            for local, servidor in parear_insercao(payload['registros'], resposta,
+                                                   tabela == 'transacoes' and chave_no_servidor(rep)):
+                if servidor is None:
+                    repetidos.append(local['id'])
+                    continue
+                trocar_id(con, tabela, local['id'], servidor['id'])
+                rep['ids_reais'][local['id']] = servidor['id']
+                rep['aguardando'][local['id']] = weakref.WeakSet(sessoes)
+                eventos.append({'tipo': 'ID_CONFIRMADO', 'tabela': tabela, 'provisorio': local['id'], 'registro': servidor})
+        elif op == 'update':
+            achados = {r[CHAVE_REPLICA[tabela]] for r in resposta or []}
+            sumidos = [i for i in payload['ids'] if i not in achados]
+    for evento in eventos:
+        feed['publicar'](evento)
+    if eventos and tabela != 'transacoes':
+        limpar_referencias(tabela)  # as telas releem fixos/regras já com o id do banco
+    if resposta and op != 'delete':
+        aplicar_do_servidor(rep, feed, tabela, resposta)  # colunas preenchidas pelo banco (ex.: updated_at)
+    if repetidos:
+        aplicar_do_servidor(rep, feed, tabela, excluidos=repetidos)
+        pedir_sincronizacao(rep, 'delta')
+    if sumidos:
+        aplicar_do_servidor(rep, feed, tabela, excluidos=sumidos)
+        feed['publicar']({'tipo': 'AVISO', 'texto': f"{len(sumidos)} alteração(ões) feitas sem conexão eram de "
+                                                     "lançamentos já excluídos em outro aparelho."})
+
+def desfazer_recusada(rep, feed, seq, tabela, op, payload, erro):
+    """Descarta a entrada recusada e traz do banco a versão atual das linhas que ela tocava."""
+    chave = CHAVE_REPLICA[tabela]
+    chaves = payload.get('ids') or [r[chave] for r in payload.get('registros', [])]
+    servidor = [] if op == 'insert' else ler_do_servidor(rep, tabela, chaves)
+    with rep['lock'], rep['con'] as con:
+        con.execute("DELETE FROM outbox WHERE seq = ?", (seq,))
+    voltaram = {r[chave] for r in servidor}
+    aplicar_do_servidor(rep, feed, tabela, servidor, [c for c in chaves if c not in voltaram])
+    feed['publicar']({'tipo': 'AVISO', 'texto': f"Alteração não salva pelo banco e desfeita: {erro}"})
+
+def colunas_opcionais(rep, marca) -> list:
+    """Colunas de transacoes que só entram no select se o banco as tiver."""
+    return (['chave_idempotencia'] if chave_no_servidor(rep) else []) + (['updated_at'] if marca.get('updated_at') else [])
+
+def colunas_servidor(rep, tabela: str) -> str:
+    if tabela != 'transacoes':
+        return COLUNAS_REFERENCIA[tabela]
+    marca = ler_estado(conexao_leitura(rep), 'marca') or {}
+    # updated_at só vem junto quando a tabela tem a coluna (é ela que move a marca)
+    return select_transacoes(*colunas_opcionais(rep, marca))
+
+def ler_do_servidor(rep, tabela: str, chaves):
+    if not chaves:
+        return []
+    return supabase.table(tabela).select(colunas_servidor(rep, tabela)).in_(CHAVE_REPLICA[tabela], list(chaves)).execute().data or []
+
+def limpar_referencias(tabela: str):
+    {'fixos': buscar_fixos, 'metas': buscar_metas, 'pessoas': buscar_pessoas, 'regras_categoria': buscar_regras}[tabela].clear()
+
+def aplicar_do_servidor(rep, feed, tabela: str, registros=(), excluidos=()):
+    """Leva para a réplica linhas vindas do banco e repassa às sessões só o que mudou."""
+    chave, colunas = CHAVE_REPLICA[tabela], COLUNAS_REPLICA[tabela]
+    with rep['lock'], rep['con'] as con:
+        pendentes = ids_pendentes(con, tabela)
+        novos = [r for r in registros if r.get(chave) is not None and r[chave] not in pendentes]
+        excluidos = [c for c in excluidos if c is not None and c not in pendentes]
+        chaves = [r[chave] for r in novos] + excluidos
+        atuais = {r[chave]: dict(r) for r in con.execute(
+            f"SELECT * FROM {tabela} WHERE {chave} IN ({marcadores(chaves)})", chaves)}
+        # coluna que o banco não mandou (ex.: chave_idempotencia sem a migração) fica com o valor local
+        novos = [{**{c: v for c, v in atuais.get(r[chave], {}).items() if c not in r}, **r} for r in novos]
+        mudaram = [r for r in novos
+                   if [atuais.get(r[chave], {}).get(c) for c in colunas] != [r.get(c) for c in colunas]]
+        sairam = [c for c in excluidos if c in atuais]
+        aplicar_na_replica(con, tabela, 'insert', {'registros': mudaram})
+        aplicar_na_replica(con, tabela, 'delete', {'ids': sairam})
+    if not (mudaram or sairam):
+        return
+    if tabela != 'transacoes':
+        limpar_referencias(tabela)
+        return
+    for r in mudaram:
+        feed['publicar']({'tipo': 'UPSERT', 'registro': r})
+    for c in sairam:
+        feed['publicar']({'tipo': 'DELETE', 'antigo': {'id': c}})
+
+TAMANHO_PAGINA = 1000  # linhas por página (o max-rows padrão do PostgREST no Supabase)
+
+def contar_transacoes():
+    """Total de linhas de transacoes (count=exact, uma linha na resposta); None se o banco não informar."""
+    return supabase.table("transacoes").select("id", count="exact").limit(1).execute().count
+
+def paginas_transacoes(colunas: str, filtrar=None, tamanho: int = TAMANHO_PAGINA):
+    """Percorre transacoes em páginas por id (keyset, sem OFFSET); só uma página vazia encerra."""
+    ultimo = None
+    while True:
+        query = supabase.table("transacoes").select(colunas)
+        if filtrar is not None:
+            query = filtrar(query)
+        if ultimo is not None:
+            query = query.gt("id", ultimo)
+        pagina = query.order("id").limit(tamanho).execute().data or []
+        if not pagina:
+            return
+        yield pagina
+        ultimo = pagina[-1]['id']
+
+def puxar_tudo(rep, feed):
+    """Carga completa de transacoes para a réplica, seguida de um delta desde a marca anterior à carga."""
+    with ThreadPoolExecutor(max_workers=3, thread_name_prefix="marca") as pool:
+        f_total = pool.submit(contar_transacoes)
+        marca = buscar_marca_servidor(pool)
+        total = f_total.result()
+    extras = colunas_opcionais(rep, marca)
+    colunas = COLUNAS_REPLICA['transacoes']
+    rep['progresso'] = {'carregadas': 0, 'total': total}
+    try:
+        with rep['lock'], rep['con'] as con:
+            con.execute("DROP TABLE IF EXISTS temp.carga_transacoes")
+            con.execute("CREATE TEMP TABLE carga_transacoes AS SELECT * FROM main.transacoes WHERE 0")
+        for pagina in paginas_transacoes(select_transacoes(*extras)):
+            with rep['lock'], rep['con'] as con:
+                con.executemany(f"INSERT INTO temp.carga_transacoes ({', '.join(colunas)}) VALUES ({marcadores(colunas)})",
+                                [tuple(r.get(c) for c in colunas) for r in pagina])
+            rep['progresso']['carregadas'] += len(pagina)
+        if marca['id'] is None:
+            marca['id'] = 0  # tabela vazia (ou sem resposta): o delta segue por id
+        with rep['lock'], rep['con'] as con:
+            pendentes = list(ids_pendentes(con, 'transacoes'))
+            con.execute(f"DELETE FROM main.transacoes WHERE id > 0 AND id NOT IN ({marcadores(pendentes)})", pendentes)
+            con.execute(f"INSERT INTO main.transacoes SELECT * FROM temp.carga_transacoes WHERE id NOT IN ({marcadores(pendentes)})",
+                        pendentes)
+            con.execute("DROP TABLE temp.carga_transacoes")
+            gravar_estado(con, 'marca', marca)
+    finally:
+        rep['progresso'] = None
+    feed['publicar']({'tipo': 'RECARREGAR'})
+    puxar_delta(rep, feed)
+
+def puxar_delta(rep, feed):
+    """Só as linhas alteradas no banco desde a marca d'água da réplica (sem marca, carga completa)."""
+    marca = ler_estado(conexao_leitura(rep), 'marca') or {}
+    if marca.get('updated_at') is None and marca.get('id') is None:
+        puxar_tudo(rep, feed)
+        return
+    # a marca só avança aqui, ao fim da varredura, e até o que o banco tinha antes dela começar
+    nova = calcular_marca([buscar_marca_servidor()], marca)
+    if marca.get('updated_at'):
+        # gte + comparação com a réplica: não perde linhas gravadas no mesmo instante da marca
+        filtrar = lambda q: q.gte("updated_at", marca['updated_at'])
+    else:
+        filtrar = lambda q: q.gt("id", marca['id'])
+    for pagina in paginas_transacoes(colunas_servidor(rep, 'transacoes'), filtrar):
+        aplicar_do_servidor(rep, feed, 'transacoes', pagina)
+    with rep['lock'], rep['con'] as con:
+        gravar_estado(con, 'marca', nova)
+
+def ids_no_banco(total=None):
+    """Todos os ids de transacoes, em ordem, num array int64."""
+    ids, n = np.empty(total or TAMANHO_PAGINA, dtype='int64'), 0
+    for pagina in paginas_transacoes("id"):
+        if n + len(pagina) > len(ids):
+            ids = np.resize(ids, max(2 * len(ids), n + len(pagina)))
+        ids[n:n + len(pagina)] = [r['id'] for r in pagina]
+        n += len(pagina)
+    return ids[:n]
+
+def conferir_exclusoes(rep, feed):
+    """Tira da réplica as linhas excluídas no banco (o delta não enxerga exclusões)."""
+    locais = pd.read_sql_query("SELECT id FROM transacoes WHERE id > 0", conexao_leitura(rep))['id']
+    sumidos = np.setdiff1d(locais.to_numpy(dtype='int64'), ids_no_banco(contar_transacoes()), assume_unique=True)
+    aplicar_do_servidor(rep, feed, 'transacoes', excluidos=sumidos.tolist())
+
+SALDO_REPLICA = """
+    SELECT COALESCE(SUM(CASE WHEN tipo = 'Entrada' THEN CAST(ROUND(valor * 100) AS INTEGER) END), 0) AS entradas,
+           COALESCE(SUM(CASE WHEN tipo = 'Saída' AND COALESCE(status, 'Pago') = 'Pago'
+                             THEN CAST(ROUND(valor * 100) AS INTEGER) END), 0) AS saidas_pagas,
+           COALESCE(SUM(CASE WHEN status = 'Em Negociação' THEN CAST(ROUND(valor * 100) AS INTEGER) END), 0) AS em_negociacao,
+           COUNT(*) AS qtd, COALESCE(MAX(id), 0) AS id_max
+    FROM transacoes WHERE id > 0"""
+
+def conferir_replica(rep, feed):
+    """Compara a réplica com saldo_geral() e, se divergirem, acerta só os meses diferentes (resumo_mensal())."""
+    if conexao_leitura(rep).execute("SELECT 1 FROM outbox LIMIT 1").fetchone():
+        return  # escritas ainda não enviadas mudam as somas locais: confere no próximo ciclo
+    try:
+        banco = (supabase.rpc("saldo_geral").execute().data or [{}])[0]
+        if {k: banco.get(k) for k in ('entradas', 'saidas_pagas', 'em_negociacao', 'qtd', 'id_max')} == \
+                ler_replica(rep, SALDO_REPLICA)[0]:
+            return
+        parciais = supabase.rpc("resumo_mensal").execute().data or []
+    except ERROS_DE_REDE:
+        raise
+    except Exception:
+        conferir_exclusoes(rep, feed)  # sem as funções de sql/metricas.sql: varre os ids
+        return
+    cubo_banco, _ = montar_cubo(parciais)
+    cubo_local, _ = consultar_cubo(rep)
+    diferenca = cubo_banco.sub(cubo_local, fill_value=0)
+    meses = diferenca[(diferenca != 0).any(axis=1)].index.droplevel(CHAVES_CUBO[2:]).unique()
+    for ano, mes in meses:
+        if ano > 0:  # 0: linhas sem data válida, que não dá para filtrar por mês
+            puxar_mes(rep, feed, ano, mes)
+    local = ler_replica(rep, SALDO_REPLICA)[0]
+    if (local['qtd'], local['id_max']) != (banco.get('qtd'), banco.get('id_max')):
+        conferir_exclusoes(rep, feed)  # exclusão que os meses não explicam (ex.: linha sem data)
+
+def puxar_mes(rep, feed, ano: int, mes: int):
+    """Traz do banco todas as linhas de um mês e tira da réplica as que não vieram."""
+    inicio, fim = limites_mes(ano, mes)
+    registros = [r for pagina in paginas_transacoes(colunas_servidor(rep, 'transacoes'),
+                                                    lambda q: q.gte("data", str(inicio)).lt("data", str(fim)))
+                 for r in pagina]
+    vieram = {r['id'] for r in registros}
+    locais = ler_replica(rep, "SELECT id FROM transacoes WHERE id > 0 AND data >= ? AND data < ?", (str(inicio), str(fim)))
+    aplicar_do_servidor(rep, feed, 'transacoes', registros, [r['id'] for r in locais if r['id'] not in vieram])
+
+def puxar_referencias(rep):
+    """fixos, metas, pessoas e regras inteiros (tabelas pequenas), preservando o que ainda está na outbox."""
+    for tabela, colunas in COLUNAS_REFERENCIA.items():
+        try:
+            registros = supabase.table(ORIGEM_REPLICA.get(tabela, tabela)).select(colunas).execute().data or []
+        except APIError:
+            if tabela not in REFERENCIAS_OPCIONAIS:
+                raise
+            registros = []
+        chave = CHAVE_REPLICA[tabela]
+        with rep['lock'], rep['con'] as con:
+            pendentes = ids_pendentes(con, tabela)
+            con.execute(f"DELETE FROM {tabela} WHERE {chave} NOT IN ({marcadores(pendentes)})", list(pendentes))
+            aplicar_na_replica(con, tabela, 'insert', {'registros': [r for r in registros if r[chave] not in pendentes]})
+        limpar_referencias(tabela)
+
+# ============================
+# LANÇAMENTO DOS FIXOS NO MÊS
+# ============================
+def chave_fixo(fixo_id: int, ano: int, mes: int) -> str:
+    """Chave de idempotência do lançamento de um fixo num mês: 'fixo:<id>:<AAAA-MM>'."""
+    return f"fixo:{fixo_id}:{ano:04d}-{mes:02d}"
+
+def lancar_fixos(rep, feed, ano: int, mes: int, ids=None, exceto=None):
+    """
+    Lança os fixos (todos, ou só 'ids') no mês numa única inserção, sem repetir os já lançados.
+    Devolve os registros lançados.
+    """
+    with rep['lock']:
+        fixos = [dict(r) for r in rep['con'].execute(
+            "SELECT id, descricao, valor, categoria, responsavel FROM fixos WHERE id > 0 ORDER BY id")
+            if ids is None or r['id'] in ids]
+        chaves = [chave_fixo(f['id'], ano, mes) for f in fixos]
+        lancadas = {r[0] for r in rep['con'].execute(
+            f"SELECT chave_idempotencia FROM transacoes WHERE chave_idempotencia IN ({marcadores(chaves)})", chaves)}
+        do_dia_1 = Counter(tuple(r) for r in rep['con'].execute(
+            "SELECT descricao, CAST(ROUND(valor * 100) AS INTEGER), categoria FROM transacoes "
+            "WHERE substr(data, 1, 10) = ? AND tipo = 'Saída' "
+            "AND (chave_idempotencia IS NULL OR chave_idempotencia NOT LIKE 'fixo:%')", (str(date(ano, mes, 1)),)))
+        for f, chave in zip(fixos, chaves):
+            iguais = (f['descricao'], para_centavos(f['valor']), f['categoria'])
+            if chave not in lancadas and do_dia_1[iguais] > 0:
+                do_dia_1[iguais] -= 1  # cada lançamento antigo vale por um fixo só
+                lancadas.add(chave)
+        registros = [{
+            "id": novo_id_provisorio(), "data": str(date(ano, mes, 1)), "descricao": f['descricao'],
+            "valor": f['valor'], "tipo": "Saída", "categoria": f['categoria'], "status": "Pago",
+            "responsavel": f['responsavel'] or "Ambos", "chave_idempotencia": chave,
+        } for f, chave in zip(fixos, chaves) if chave not in lancadas]
+        if registros:
+            gravar_escrita(rep, feed, 'transacoes', 'insert', {'registros': registros}, exceto)
+    return registros
+
+def lancar_fixos_na_sessao(ano: int, mes: int, ids=None) -> int:
+    """lancar_fixos pela tela: os lançamentos entram no store desta sessão na hora."""
+    registros = lancar_fixos(replica(), feed_alteracoes(url, key), ano, mes, ids,
+                             exceto=st.session_state.get('fila_alteracoes'))
+    if registros:
+        mesclar_dados(normalizar_transacoes(registros))
+    return len(registros)
+
+def lancar_fixos_agendado(rep, feed):
+    """Lança os fixos do mês corrente uma vez por mês (LANCAR_FIXOS_AUTOMATICO)."""
+    hoje = date.today()
+    mes = f"{hoje.year:04d}-{hoje.month:02d}"
+    if ler_estado(conexao_leitura(rep), 'fixos_lancados') == mes:
+        return
+    lancados = lancar_fixos(rep, feed, hoje.year, hoje.month)
+    with rep['lock'], rep['con'] as con:
+        gravar_estado(con, 'fixos_lancados', mes)
+    if lancados:
+        feed['publicar']({'tipo': 'AVISO', 'texto': f"{len(lancados)} fixo(s) lançado(s) em {hoje.month:02d}/{hoje.year}."})
+
+# ============================
+# CATEGORIZAÇÃO AUTOMÁTICA (regras)
+# ============================
+CATEGORIA_AUTOMATICA = "🤖 Automática"  # opção dos formulários: a categoria sai das regras
+CATEGORIA_PADRAO = "✨ Outros"           # quando nenhuma regra casa
+
+def sem_acento(textos):
+    """Texto sem acentos, de forma vetorizada: base comum de descrições e padrões."""
+    return textos.str.normalize('NFKD').str.encode('ascii', 'ignore').str.decode('ascii')
+
+def validar_padrao(padrao: str, regex: bool):
+    """Mensagem de erro do padrão de uma regra, ou None se ele for válido."""
+    if not str(padrao or '').strip():
+        return "Informe o texto a procurar na descrição."
+    if regex:
+        try:
+            re.compile(padrao)
+        except re.error as e:
+            return f"Expressão regular inválida: {e}"
+    return None
+
+def montar_automato(palavras):
+    """Autômato de Aho-Corasick das palavras: numa passada pelo texto acha todas, inclusive as sobrepostas."""
+    proximo, falha, saidas = [{}], [0], [set()]
+    for i, palavra in enumerate(palavras):
+        estado = 0
+        for c in palavra:
+            if c not in proximo[estado]:
+                proximo[estado][c] = len(proximo)
+                proximo.append({}); falha.append(0); saidas.append(set())
+            estado = proximo[estado][c]
+        saidas[estado].add(i)
+    fila = deque(proximo[0].values())  # em largura: a falha de um estado sempre é mais rasa que ele
+    while fila:
+        estado = fila.popleft()
+        for c, filho in proximo[estado].items():
+            f = falha[estado]
+            while f and c not in proximo[f]:
+                f = falha[f]
+            falha[filho] = proximo[f].get(c, 0)
+            saidas[filho] |= saidas[falha[filho]]
+            fila.append(filho)
+    return proximo, falha, [frozenset(s) for s in saidas]
+
+def buscar_palavras(automato, texto: str) -> set:
+    """Índices das palavras do autômato que aparecem no texto."""
+    proximo, falha, saidas = automato
+    estado, achadas = 0, set()
+    for c in texto:
+        while estado and c not in proximo[estado]:
+            estado = falha[estado]
+        estado = proximo[estado].get(c, 0)
+        if saidas[estado]:
+            achadas |= saidas[estado]
+    return achadas
+
+@st.cache_resource(max_entries=4, show_spinner=False)
+def compilar_regras(regras):
+    """Autômato das palavras-chave, os regex compilados à parte e a tabela regra -> grupo (padrão)."""
+    tabela = pd.DataFrame(regras, columns=COLUNAS_REPLICA['regras_categoria'])
+    tabela['regex'] = tabela['regex'].fillna(False).astype(bool)
+    tabela['texto'] = sem_acento(tabela['padrao'].fillna('').astype(str).str.strip())
+    tabela['texto'] = tabela['texto'].where(tabela['regex'], tabela['texto'].str.lower())
+    tabela = tabela[[t != '' and validar_padrao(t, rx) is None for t, rx in zip(tabela['texto'], tabela['regex'])]]
+    if tabela.empty:
+        return None, {}, None
+    palavras = list(dict.fromkeys(tabela.loc[~tabela['regex'], 'texto']))
+    expressoes = list(dict.fromkeys(tabela.loc[tabela['regex'], 'texto']))
+    grupos = {**{(t, False): f"p{i}" for i, t in enumerate(palavras)},
+              **{(t, True): f"r{i}" for i, t in enumerate(expressoes)}}
+    tabela['grupo'] = [grupos[(t, rx)] for t, rx in zip(tabela['texto'], tabela['regex'])]
+    tabela['centavos_min'] = para_centavos(tabela['valor_min'])
+    tabela['centavos_max'] = para_centavos(tabela['valor_max'])
+    tabela['responsavel'] = tabela['responsavel'].fillna('').astype(str)
+    return (montar_automato(palavras), {f"r{i}": re.compile(t, re.IGNORECASE) for i, t in enumerate(expressoes)},
+            tabela[['id', 'grupo', 'categoria', 'centavos_min', 'centavos_max', 'responsavel']])
+
+def classificar_categorias(descricoes, centavos, responsaveis, padrao: str = CATEGORIA_PADRAO):
+    """Categoria de cada lançamento pela regra mais antiga que casa e passa nos filtros."""
+    resultado = pd.Series(padrao, index=descricoes.index, dtype=object)
+    automato, expressoes, tabela = compilar_regras(buscar_regras())
+    if tabela is None or descricoes.empty:
+        return resultado
+    textos = sem_acento(descricoes.fillna('').astype(str))
+    unicos = textos.unique()
+    # palavras-chave: uma passada do autômato por descrição distinta; só os regex vão um a um
+    pares = [(t, f"p{i}") for t, minusculo in zip(unicos, pd.Series(unicos).str.lower())
+             for i in buscar_palavras(automato, minusculo)]
+    pares += [(t, g) for g, rx in expressoes.items() for t in unicos if rx.search(t)]
+    pares = pd.DataFrame(pares, columns=['texto', 'grupo'])
+    base = pd.DataFrame({'texto': textos.to_numpy(), 'centavos': np.asarray(centavos, dtype='int64'),
+                         'responsavel': np.asarray(responsaveis, dtype=object), 'pos': np.arange(len(textos))})
+    candidatos = base.merge(pares, on='texto').merge(tabela, on='grupo', suffixes=('', '_regra'))
+    aplica = (
+        (candidatos['centavos_min'].eq(0) | candidatos['centavos'].ge(candidatos['centavos_min'])) &
+        (candidatos['centavos_max'].eq(0) | candidatos['centavos'].le(candidatos['centavos_max'])) &
+        (candidatos['responsavel_regra'].eq('') | candidatos['responsavel'].eq(candidatos['responsavel_regra']))
+    )
+    escolhidas = candidatos[aplica].sort_values('id').drop_duplicates('pos')
+    resultado.iloc[escolhidas['pos'].to_numpy()] = escolhidas['categoria'].to_numpy()
+    return resultado
+
+def categoria_automatica(descricao: str, centavos: int, responsavel: str) -> str:
+    """Categoria de um único lançamento (formulário Novo)."""
+    return classificar_categorias(pd.Series([descricao]), [centavos], [responsavel]).iloc[0]
+
+# ============================
+# IMPORTAÇÃO DE EXTRATOS (OFX/CSV)
+# ============================
+LOTE_IMPORTACAO = 500  # linhas por leitura do arquivo e por INSERT no banco
+COLUNAS_EXTRATO = {
+    'data': ('data', 'data lançamento', 'data lancamento', 'data movimento', 'date'),
+    'descricao': ('descrição', 'descricao', 'histórico', 'historico', 'lançamento', 'lancamento', 'memo', 'description'),
+    'valor': ('valor', 'valor (r$)', 'valor r$', 'amount'),
+}
+PADRAO_OFX = re.compile(r'<(/?)([A-Za-z0-9.]+)>([^<]*)')
+
+def abrir_texto(arquivo):
+    """Upload como texto lido sob demanda: UTF-8 se a amostra decodificar, senão cp1252 (comum em bancos)."""
+    amostra = arquivo.read(65536)
+    arquivo.seek(0)
+    try:
+        codecs.getincrementaldecoder('utf-8')().decode(amostra, final=False)
+        codificacao = 'utf-8-sig'
+    except UnicodeDecodeError:
+        codificacao = 'cp1252'
+    return io.TextIOWrapper(arquivo, encoding=codificacao, errors='replace', newline='')
+
+def ler_valores(textos):
+    """'1.234,56', '-45.90', 'R$ 10,00' -> float com sinal, de forma vetorizada."""
+    textos = textos.fillna('').astype(str).str.replace(r'[R$\s]', '', regex=True)
+    brasileiro = textos.str.contains(',', regex=False)
+    textos = textos.where(~brasileiro, textos.str.replace('.', '', regex=False).str.replace(',', '.', regex=False))
+    return pd.to_numeric(textos, errors='coerce')
+
+def ler_datas(textos, formato='%d/%m/%Y'):
+    """Datas no formato dado (padrão dd/mm/aaaa); o que não casar tenta ISO (aaaa-mm-dd)."""
+    datas = pd.to_datetime(textos, format=formato, errors='coerce')
+    faltam = datas.isna() & textos.notna()
+    if faltam.any():
+        datas[faltam] = pd.to_datetime(textos[faltam], format='ISO8601', errors='coerce')
+    return datas
+
+def ler_extrato_csv(arquivo):
+    """Lotes (data, descricao, valor) de um CSV de banco, lido em pedaços; separador detectado."""
+    leitor = pd.read_csv(abrir_texto(arquivo), sep=None, engine='python', dtype=str,
+                         skipinitialspace=True, chunksize=LOTE_IMPORTACAO)
+    for lote in leitor:
+        nomes = {str(c).strip().lower(): c for c in lote.columns}
+        colunas = {}
+        for campo, apelidos in COLUNAS_EXTRATO.items():
+            achada = next((nomes[a] for a in apelidos if a in nomes), None)
+            if achada is None:
+                raise ValueError(f"CSV sem coluna de {campo} (esperado uma de: {', '.join(apelidos)})")
+            colunas[campo] = achada
+        yield pd.DataFrame({
+            'data': ler_datas(lote[colunas['data']].str.strip()),
+            'descricao': lote[colunas['descricao']],
+            'valor': ler_valores(lote[colunas['valor']]),
+        })
+
+def ler_extrato_ofx(arquivo):
+    """
+    Lotes (data, descricao, valor) de um OFX, linha a linha. Aceita o SGML
+    dos bancos (tags sem fechamento) e o XML compacto (tudo numa linha).
+    """
+    def lote_ofx(transacoes):
+        df = pd.DataFrame(transacoes, columns=['DTPOSTED', 'TRNAMT', 'MEMO', 'NAME'])
+        return pd.DataFrame({
+            'data': ler_datas(df['DTPOSTED'].str.slice(0, 8), formato='%Y%m%d'),
+            'descricao': df['MEMO'].where(df['MEMO'].fillna('').str.strip() != '', df['NAME']),
+            'valor': ler_valores(df['TRNAMT']),
+        })
+
+    transacoes, atual = [], None
+    for linha in abrir_texto(arquivo):
+        for fecha, tag, valor in PADRAO_OFX.findall(linha):
+            tag = tag.upper()
+            if tag == 'STMTTRN':
+                if not fecha:
+                    atual = {}
+                elif atual is not None:
+                    transacoes.append(atual)
+                    atual = None
+                    if len(transacoes) >= LOTE_IMPORTACAO:
+                        yield lote_ofx(transacoes)
+                        transacoes = []
+            elif atual is not None and not fecha:
+                atual[tag] = valor.strip()
+    if transacoes:
+        yield lote_ofx(transacoes)
+
+def mapear_extrato(lote, responsavel: str, categoria: str):
+    """
+    Linhas do extrato no esquema de transacoes: sinal vira o tipo e o valor
+    fica positivo. Com CATEGORIA_AUTOMATICA, a categoria sai das regras.
+    """
+    lote = lote[lote['data'].notna() & lote['valor'].notna() & lote['valor'].ne(0)]
+    centavos = para_centavos(lote['valor'])
+    mapeado = pd.DataFrame({
+        'data': lote['data'].dt.strftime('%Y-%m-%d'),
+        'descricao': lote['descricao'].fillna('').astype(str).str.strip(),
+        'valor': em_reais(centavos.abs()),
+        'tipo': np.where(centavos > 0, 'Entrada', 'Saída'),
+        'categoria': categoria,
+        'status': 'Pago',
+        'responsavel': responsavel,
+    }).reset_index(drop=True)
+    if categoria == CATEGORIA_AUTOMATICA:
+        mapeado['categoria'] = classificar_categorias(mapeado['descricao'], para_centavos(mapeado['valor']),
+                                                      mapeado['responsavel']).to_numpy()
+    return mapeado
+
+def hash_lancamentos(df):
+    """Hash (uint64) de data + valor + tipo + descrição normalizada: a chave da deduplicação."""
+    chave = pd.DataFrame({
+        'data': df['data'].astype(str).str.slice(0, 10),
+        'centavos': para_centavos(df['valor']),
+        'tipo': df['tipo'].fillna('').astype(str),
+        'descricao': df['descricao'].fillna('').astype(str).str.upper().str.split().str.join(' '),
+    })
+    return pd.util.hash_pandas_object(chave, index=False)
+
+def importar_extrato(arquivo, responsavel: str, categoria: str):
+    """
+    Importa um extrato OFX/CSV em lotes, pulando lançamentos que já existem.
+    Devolve (importados, repetidos).
+    """
+    leitor = ler_extrato_ofx if arquivo.name.lower().endswith('.ofx') else ler_extrato_csv
+    existentes = pd.read_sql_query("SELECT data, valor, tipo, descricao FROM transacoes", conexao_leitura(replica()))
+    existentes = hash_lancamentos(existentes).value_counts()
+    vistos = pd.Series(dtype='int64')  # ocorrências de cada hash já lidas do arquivo
+    importados = repetidos = 0
+    for lote in leitor(arquivo):
+        lote = mapear_extrato(lote, responsavel, categoria)
+        if lote.empty:
+            continue
+        hashes = hash_lancamentos(lote)
+        ocorrencia = hashes.map(vistos).fillna(0).astype('int64') + hashes.groupby(hashes).cumcount()
+        novo = ocorrencia >= hashes.map(existentes).fillna(0).astype('int64')
+        vistos = vistos.add(hashes.value_counts(), fill_value=0).astype('int64')
+        repetidos += int((~novo).sum())
+        lote = lote[novo]
+        if lote.empty:
+            continue
+        registros = lote.assign(id=[novo_id_provisorio() for _ in range(len(lote))]).to_dict('records')
+        mesclar_dados(normalizar_transacoes(registros))
+        registrar_escrita('transacoes', 'insert', registros=registros)
+        importados += len(registros)
+    return importados, repetidos
+
 # ============================
 # FUNÇÕES DE RELATÓRIO
 # ============================
+COLUNAS_EXCEL = ['data', 'descricao', 'valor', 'tipo', 'status', 'responsavel', 'categoria', 'id']
+LARGURAS_EXCEL = [12, 40, 14, 10, 16, 14, 18, 8]
+
+def nome_aba_excel(nome: str, usados: set) -> str:
+    """Nome de aba válido no Excel (sem []:*?/\\, até 31 caracteres e único)."""
+    base = ''.join(ch for ch in str(nome) if ch not in '[]:*?/\\')[:31] or 'Aba'
+    nome_final, n = base, 2
+    while nome_final.lower() in usados:
+        sufixo = f" ({n})"
+        nome_final, n = base[:31 - len(sufixo)] + sufixo, n + 1
+    usados.add(nome_final.lower())
+    return nome_final
+
 def gerar_excel(df):
+    """Exporta para Excel, com abas por mês e por responsável."""
     output = io.BytesIO()
-    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-        df_exp = df.copy()
-        df_exp['data'] = pd.to_datetime(df_exp['data'], errors='coerce').dt.strftime('%d/%m/%Y')
-        # Inclui Responsável
-        colunas = ['data', 'descricao', 'valor', 'tipo', 'status', 'responsavel', 'categoria', 'id']
-        for c in colunas:
-            if c not in df_exp.columns:
-                df_exp[c] = ''
-        df_exp = df_exp[colunas]
-        df_exp.to_excel(writer, index=False, sheet_name='Lançamentos')
+    wb = xlsxwriter.Workbook(output, {'constant_memory': True})
+    fmt_cab = wb.add_format({'bold': True, 'bg_color': '#E6ECF5', 'border': 1})
+    fmt_data = wb.add_format({'num_format': 'dd/mm/yyyy'})
+    fmt_valor = wb.add_format({'num_format': 'R$ #,##0.00'})
+
+    datas = pd.to_datetime(df['data'], errors='coerce')
+    ordem = pd.DataFrame({
+        'data': datas, 'descricao': df['descricao'].fillna('').astype(str),
+    }).sort_values(by=['data', 'descricao'], na_position='last').index
+
+    def coluna(nome, padrao=''):
+        serie = df[nome] if nome in df.columns else pd.Series(padrao, index=df.index)
+        return serie.reindex(ordem).fillna(padrao).tolist()
+
+    datas_ord = datas.reindex(ordem)
+    valores = em_reais(df['centavos'].reindex(ordem)).tolist()
+    descs, tipos, status, resps = coluna('descricao'), coluna('tipo'), coluna('status', 'Pago'), coluna('responsavel', 'Ambos')
+    cats, ids = coluna('categoria'), coluna('id')
+    chaves_mes = (datas_ord.dt.year.fillna(0).astype(int) * 100 + datas_ord.dt.month.fillna(0).astype(int)).tolist()
+
+    usados = set()
+    def nova_aba(titulo):
+        ws = wb.add_worksheet(nome_aba_excel(titulo, usados))
+        ws.write_row(0, 0, COLUNAS_EXCEL, fmt_cab)
+        for i, largura in enumerate(LARGURAS_EXCEL):
+            ws.set_column(i, i, largura)
+        return [ws, 1]
+
+    # Abas criadas antes das linhas (ordem fixa); linhas escritas em ordem crescente em cada aba
+    aba_geral = nova_aba('Lançamentos')
+    chaves_unicas = sorted(set(chaves_mes), key=lambda ch: (ch == 0, ch))  # "Sem data" por último
+    abas_mes = {}
+    if len(chaves_unicas) > 1:
+        for ch in chaves_unicas:
+            titulo = f"{meses[ch % 100 - 1]} {ch // 100}" if ch % 100 else "Sem data"
+            abas_mes[ch] = nova_aba(titulo)
+    abas_resp = {r: nova_aba(f"Resp - {r}") for r in sorted(set(map(str, resps)))}
+
+    for dt, desc, val, tp, st_, resp, cat, rid, ch in zip(
+        datas_ord.tolist(), descs, valores, tipos, status, resps, cats, ids, chaves_mes
+    ):
+        for aba in (aba_geral, abas_mes.get(ch), abas_resp[str(resp)]):
+            if aba is None:
+                continue
+            ws, linha = aba
+            if pd.notna(dt):
+                ws.write_datetime(linha, 0, dt.to_pydatetime(), fmt_data)
+            ws.write_string(linha, 1, str(desc))
+            ws.write_number(linha, 2, val, fmt_valor)
+            ws.write_row(linha, 3, [str(tp), str(st_), str(resp), str(cat), rid])
+            aba[1] = linha + 1
+
+    wb.close()
     return output.getvalue()
 
+LINHAS_POR_PAGINA_PDF = 38  # cabe numa página A4 com fonte 9 (a 1ª página tem o título)
+CABECALHO_PDF = ["Data", "Descricao", "Valor", "Tipo", "Status", "Responsável"]
+
+class TabelaPaginaPDF(Flowable):
+    """Uma página da tabela do relatório, montada só na hora de desenhar."""
+    def __init__(self, colunas, inicio, fim, larguras, estilo):
+        super().__init__()
+        self.colunas = colunas
+        self.inicio, self.fim = inicio, fim
+        self.larguras = larguras
+        self.estilo = estilo
+        self._tbl = None
+
+    def _montar(self):
+        linhas = [list(c[self.inicio:self.fim]) for c in self.colunas]
+        tbl = Table([CABECALHO_PDF] + [list(r) for r in zip(*linhas)], colWidths=self.larguras, repeatRows=1)
+        tbl.setStyle(self.estilo)
+        return tbl
+
+    def wrap(self, aw, ah):
+        self._tbl = self._montar()
+        return self._tbl.wrap(aw, ah)
+
+    def split(self, aw, ah):
+        # Fallback se a página não couber inteira (cabeçalho se repete no pedaço seguinte)
+        return self._montar().split(aw, ah)
+
+    def draw(self):
+        self._tbl.drawOn(self.canv, 0, 0)
+        self._tbl = None
+
 def gerar_pdf(df, nome_mes):
     """
     Gera PDF com ReportLab (tabela com cabeçalho repetido e paginação automática).
@@ -324,24 +1859,25 @@ def gerar_pdf(df, nome_mes):
     """
     buffer = io.BytesIO()
 
-    # Sanitiza (sem dropar linhas)
-    df_exp = df.copy()
-    df_exp['data'] = pd.to_datetime(df_exp['data'], errors='coerce')
-    df_exp['data_fmt'] = df_exp['data'].dt.strftime('%d/%m/%Y').fillna('')
-    df_exp['descricao'] = df_exp['descricao'].fillna('').astype(str)
-    df_exp['valor'] = pd.to_numeric(df_exp['valor'], errors='coerce').fillna(0.0)
-    df_exp['tipo'] = (df_exp['tipo'] if 'tipo' in df_exp.columns else '').fillna('').astype(str)
-    df_exp['status'] = (df_exp['status'] if 'status' in df_exp.columns else 'Pago')
-    if not isinstance(df_exp['status'], pd.Series):
-        df_exp['status'] = 'Pago'
-    df_exp['status'] = df_exp['status'].fillna('Pago').astype(str)
-    df_exp['responsavel'] = (df_exp['responsavel'] if 'responsavel' in df_exp.columns else 'Ambos')
-    if not isinstance(df_exp['responsavel'], pd.Series):
-        df_exp['responsavel'] = 'Ambos'
-    df_exp['responsavel'] = df_exp['responsavel'].fillna('Ambos').astype(str)
-
-    # Ordena como no histórico
-    df_exp = df_exp.sort_values(by=['data', 'descricao'], na_position='last')
+    # Sanitiza (sem dropar linhas) e ordena como no histórico
+    datas = pd.to_datetime(df['data'], errors='coerce')
+    ordem = pd.DataFrame({
+        'data': datas,
+        'descricao': df['descricao'].fillna('').astype(str),
+    }).sort_values(by=['data', 'descricao'], na_position='last').index
+
+    def coluna(nome, padrao):
+        serie = df[nome] if nome in df.columns else pd.Series(padrao, index=df.index)
+        return serie.reindex(ordem).fillna(padrao).astype(str).to_numpy()
+
+    colunas = [
+        datas.reindex(ordem).dt.strftime('%d/%m/%Y').fillna('').to_numpy(),
+        coluna('descricao', ''),
+        formatar_moeda(df['centavos'].reindex(ordem), padrao_br=True).to_numpy(),
+        coluna('tipo', ''),
+        coluna('status', 'Pago'),
+        coluna('responsavel', 'Ambos'),
+    ]
 
     # Documento
     doc = SimpleDocTemplate(
@@ -365,20 +1901,10 @@ def gerar_pdf(df, nome_mes):
     elements.append(Paragraph(f"Relatorio Financeiro - {nome_mes}", title_style))
     elements.append(Spacer(1, 6))
 
-    # Tabela
-    header = ["Data", "Descricao", "Valor", "Tipo", "Status", "Responsável"]
-    data_rows = []
-    for _, r in df_exp.iterrows():
-        valor_txt = f"R$ {r['valor']:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
-        data_rows.append([r['data_fmt'], r['descricao'], valor_txt, r['tipo'], r['status'], r['responsavel']])
-
-    table_data = [header] + data_rows
-
     # Larguras em A4 (dentro das margens úteis)
     col_widths = [22*mm, 70*mm, 25*mm, 22*mm, 22*mm, 25*mm]
 
-    tbl = Table(table_data, colWidths=col_widths, repeatRows=1)
-    tbl.setStyle(TableStyle([
+    estilo = TableStyle([
         ('FONT', (0,0), (-1,0), 'Helvetica-Bold', 10),
         ('BACKGROUND', (0,0), (-1,0), colors.HexColor("#E6ECF5")),
         ('TEXTCOLOR', (0,0), (-1,0), colors.HexColor("#141A22")),
@@ -394,29 +1920,72 @@ def gerar_pdf(df, nome_mes):
         ('GRID', (0,0), (-1,-1), 0.5, colors.HexColor("#C8D2DC")),
         ('ROWBACKGROUNDS', (0,1), (-1,-1), [colors.white, colors.HexColor("#FAFBFD")]),
         ('VALIGN', (0,0), (-1,-1), 'MIDDLE'),
-    ]))
+    ])
+
+    # Uma tabela por página (a 1ª página perde algumas linhas para o título)
+    total = len(ordem)
+    cortes = [0, *range(LINHAS_POR_PAGINA_PDF - 3, total, LINHAS_POR_PAGINA_PDF), total]
+    for n, (inicio, fim) in enumerate(zip(cortes, cortes[1:])):
+        if n:
+            elements.append(PageBreak())
+        elements.append(TabelaPaginaPDF(colunas, inicio, fim, col_widths, estilo))
 
-    elements.append(tbl)
     doc.build(elements)
     pdf_bytes = buffer.getvalue()
     buffer.close()
     return pdf_bytes
 
 # ============================
-# SINCRONIZAÇÃO INICIAL
+# CACHE DE RELATÓRIOS (LRU por mês/ano/versão dos dados)
 # ============================
-if 'dados' not in st.session_state:
-    st.session_state.dados = buscar_dados()
-if 'metas' not in st.session_state:
-    st.session_state.metas = buscar_metas()
-if 'fixos' not in st.session_state:
-    st.session_state.fixos = buscar_fixos()
-if 'pessoas' not in st.session_state or not st.session_state.pessoas:
-    st.session_state.pessoas = buscar_pessoas()
+RELATORIOS_MAX = 16
+
+@st.cache_resource
+def cache_relatorios():
+    """LRU limitado e compartilhado pelo processo: {chave: bytes do arquivo}."""
+    return {'itens': OrderedDict(), 'lock': threading.Lock()}
+
+def versao_dados(df) -> str:
+    """Hash do conteúdo do DataFrame: muda sempre que algum lançamento muda."""
+    return hashlib.sha1(pd.util.hash_pandas_object(df, index=False).values.tobytes()).hexdigest()
+
+def relatorio_em_cache(cache, chave, gerar):
+    """Devolve o arquivo já gerado para a chave; só chama gerar() em cache miss."""
+    with cache['lock']:
+        if chave in cache['itens']:
+            cache['itens'].move_to_end(chave)
+            return cache['itens'][chave]
+    conteudo = gerar()
+    with cache['lock']:
+        cache['itens'][chave] = conteudo
+        cache['itens'].move_to_end(chave)
+        while len(cache['itens']) > RELATORIOS_MAX:
+            cache['itens'].popitem(last=False)
+    return conteudo
+
+# ============================
+# CARGA INICIAL
+# ============================
+def esperar_replica(rep):
+    """Espera o motor começar a 1ª carga numa réplica vazia; até ela acabar, as telas usam as RPCs."""
+    desde = time.monotonic()
+    with st.spinner("Conectando ao banco…"):
+        while not rep['pronta'].wait(0.25):
+            if historico_baixando(rep) or time.monotonic() - desde > ESPERA_REPLICA:
+                break
+    if not (rep['pronta'].is_set() or historico_baixando(rep)):
+        st.warning("📴 Sem conexão com o banco e ainda sem cópia local: os lançamentos aparecem quando a conexão voltar.")
+
+def carregar_inicial(ano: int, mes: int):
+    """Primeira carga da sessão, lida da réplica local; o cubo sai de semear_cubo logo depois."""
+    rep = replica()
+    if not rep['pronta'].is_set():
+        esperar_replica(rep)
+    zerar_store()
+    for chave, filtro in (janela_mes(ano, mes), janela_pendentes(), janela_negociacao()):
+        carregar_janela(chave, filtro)
 
-CATEGORIAS = ["🛒 Mercado", "🏠 Moradia", "🚗 Transporte", "🍕 Lazer", "💡 Contas", "💰 Salário", "✨ Outros"]
 meses = ["Janeiro", "Fevereiro", "Março", "Abril", "Maio", "Junho", "Julho", "Agosto", "Setembro", "Outubro", "Novembro", "Dezembro"]
-PESSOAS = st.session_state.pessoas  # ['Guilherme', 'Alynne', 'Ambos'] (dinâmico)
 
 # ============================
 # HEADER
@@ -434,41 +2003,181 @@ st.markdown("""
 hoje = date.today()
 c_m, c_a = st.columns([2, 1])
 mes_nome = c_m.selectbox("Mês", meses, index=hoje.month - 1)
-ano_ref = c_a.number_input("Ano", value=hoje.year, step=1)
+ano_ref = int(c_a.number_input("Ano", value=hoje.year, step=1))
 mes_num = meses.index(mes_nome) + 1
 
+# ============================
+# SINCRONIZAÇÃO INICIAL
+# ============================
+# Réplica local + motor que conversa com o Supabase (um por processo)
+motor_sincronizacao(url, key)
+# Inscrição antes da carga: o que mudar durante ela chega pelo feed
+assinar_alteracoes()
+aplicar_alteracoes()
+if 'dados' not in st.session_state:
+    carregar_inicial(ano_ref, mes_num)
+# Referências vêm do cache do processo a cada rerun (acerto no cache = sem leitura)
+st.session_state.metas = buscar_metas()
+st.session_state.fixos = buscar_fixos()
+st.session_state.pessoas = buscar_pessoas()
+PESSOAS = st.session_state.pessoas  # ['Guilherme', 'Alynne', 'Ambos'] (dinâmico)
+
+# Recarga completa só sob demanda: o motor refaz a réplica e as sessões recarregam dela
+if st.sidebar.button("🔄 Recarregar tudo"):
+    pedir_sincronizacao(replica(), 'completa', 'referencias')
+    st.session_state.pop('dados', None)
+    buscar_pessoas.clear(); buscar_metas.clear(); buscar_fixos.clear()
+    st.rerun()
+
+status_sincronizacao()
+acompanhar_alteracoes()
+
 # ============================
 # PROCESSAMENTO DE DADOS
 # ============================
-df_geral = st.session_state.dados.copy()
-colunas_padrao = ['id', 'data', 'descricao', 'valor', 'tipo', 'categoria', 'status', 'responsavel']
-df_mes = pd.DataFrame(columns=colunas_padrao)
-df_atrasados_passado = pd.DataFrame(columns=colunas_padrao)
-total_in = 0.0
-total_out_pagas = 0.0
-balanco = 0.0
-
-if not df_geral.empty:
-    total_in = df_geral[df_geral['tipo'] == 'Entrada']['valor'].sum()
-    total_out_pagas = df_geral[(df_geral['tipo'] == 'Saída') & (df_geral['status'] == 'Pago')]['valor'].sum()
-    balanco = total_in - total_out_pagas
-
-    df_mes = df_geral[
-        (df_geral['data'].dt.month == mes_num) &
-        (df_geral['data'].dt.year == ano_ref)
-    ].copy()
-
-    # ✅ Garante coluna responsavel no df_mes
-    if 'responsavel' not in df_mes.columns:
-        df_mes['responsavel'] = 'Ambos'
-    df_mes['responsavel'] = df_mes['responsavel'].fillna('Ambos').astype(str)
-
-    data_inicio_mes_selecionado = pd.Timestamp(date(ano_ref, mes_num, 1))
-    df_atrasados_passado = df_geral[
-        (df_geral['status'] == 'Pendente') &
-        (df_geral['data'] < data_inicio_mes_selecionado) &
-        (df_geral['tipo'] == 'Saída')
-    ].copy()
+carregar_mes(ano_ref, mes_num)
+carregar_pendentes()
+carregar_negociacao()
+if 'cubo' not in st.session_state:
+    semear_cubo()
+
+# Snapshot único do store para as telas: tudo abaixo são visões dele (sem
+# .copy()); escritas geram um novo snapshot em vez de alterar este
+df_geral = st.session_state.dados
+balanco = soma_cubo(tipo='Entrada') - soma_cubo(tipo='Saída', status='Pago')
+
+# O store é mantido ordenado por data: o mês e o "antes do mês" são fatias
+inicio_mes, fim_mes = limites_mes(ano_ref, mes_num)
+df_mes = fatia_por_data(df_geral, inicio_mes, fim_mes)
+df_passado = fatia_por_data(df_geral, fim=inicio_mes)
+df_atrasados_passado = df_passado[
+    (df_passado['status'] == 'Pendente') &
+    (df_passado['tipo'] == 'Saída')
+]
+# Histórico ainda baixando: números e atrasados vêm das RPCs (sql/metricas.sql)
+metricas_do_banco = st.session_state.get('metricas_do_banco', False)
+if metricas_do_banco:
+    df_atrasados_passado = atrasados_no_banco(inicio_mes)
+
+# ============================
+# FORMATAÇÃO VETORIZADA DOS CARDS
+# ============================
+def colunas_exibicao(df, hoje: date, icone_padrao: str = "💸"):
+    """
+    Monta de uma vez todas as colunas de exibição: ícone, rótulos de data,
+    alerta de vencimento, valor em texto e classes CSS de status/tipo.
+    """
+    datas = df['data']
+    categoria, status, tipo = df['categoria'], df['status'], df['tipo']
+
+    ex = pd.DataFrame(index=df.index)
+    ex['icon'] = categoria.str.split(' ', n=1).str[0].where(categoria.str.contains(' ', regex=False), icone_padrao)
+    ex['dt_card'] = datas.dt.strftime('%d %b').fillna('-- ---')
+    ex['dt_curta'] = datas.dt.strftime('%d/%m/%y').fillna('--/--/--')
+    ex['dt_longa'] = datas.dt.strftime('%d/%m/%Y').fillna('--/--/----')
+    ex['valor_txt'] = formatar_moeda(df['centavos']).values
+    ex['valor_class'] = tipo.eq('Entrada').map({True: 'entrada', False: 'saida'})
+    ex['s_text'] = status.astype(str)
+    # Mapeamento por categoria (não por linha): cobre todo o vocabulário
+    classes = {s: {'Pago': 'pago', 'Pendente': 'pendente'}.get(s, 'negociacao') for s in status.cat.categories}
+    ex['s_class'] = status.map(classes).astype(str)
+
+    dias = (datas.dt.normalize() - pd.Timestamp(hoje)).dt.days
+    vence = status.eq('Pendente') & tipo.eq('Saída') & datas.notna()
+    ex['txt_venc'] = ''
+    atrasada = vence & dias.lt(0)
+    ex.loc[atrasada, 'txt_venc'] = " <span class='vencimento-alerta'>Atrasada há " + (-dias[atrasada]).astype('int64').astype(str) + " dias</span>"
+    ex.loc[vence & dias.eq(0), 'txt_venc'] = " <span class='vencimento-alerta' style='color:#D97706'>Vence Hoje!</span>"
+    return ex
+
+def html_cards_historico(df, hoje: date):
+    """Markup de todos os cards do Histórico, gerado em lote."""
+    if df.empty:
+        return []
+    ex = colunas_exibicao(df, hoje)
+    return (
+        '<div class="transaction-card"><div class="transaction-left">'
+        '<div class="card-icon">' + ex['icon'] + '</div><div class="tc-info">'
+        '<div class="tc-title">' + df['descricao'] + '</div>'
+        '<div class="tc-meta">' + ex['dt_card'] + ex['txt_venc'] + '</div>'
+        '<div class="tc-meta">Responsável: <b>' + df['responsavel'].astype(str) + '</b></div>'
+        '<div class="status-badge ' + ex['s_class'] + '">' + ex['s_text'] + '</div>'
+        '</div></div>'
+        '<div class="transaction-right ' + ex['valor_class'] + '">' + ex['valor_txt'] + '</div></div>'
+    )
+
+def html_cards_negociacao(df, hoje: date):
+    """Markup de todos os cards da aba Negociação, gerado em lote."""
+    if df.empty:
+        return []
+    ex = colunas_exibicao(df, hoje, icone_padrao="💬")
+    return (
+        '<div class="transaction-card"><div class="transaction-left">'
+        '<div class="card-icon">' + ex['icon'] + '</div><div class="tc-info">'
+        '<div class="tc-title">' + df['descricao'] + '</div>'
+        '<div class="tc-meta">' + ex['dt_longa'] + ' • <b>' + df['categoria'].astype(str) + '</b></div>'
+        '<div class="status-badge negociacao">Em Negociação</div>'
+        '<div class="tc-meta">Responsável: <b>' + df['responsavel'].astype(str) + '</b></div>'
+        '</div></div>'
+        '<div class="transaction-right saida">' + ex['valor_txt'] + '</div></div>'
+    )
+
+def textos_atrasados(df, hoje: date):
+    """Linhas da lista de contas atrasadas, geradas em lote."""
+    ex = colunas_exibicao(df, hoje)
+    return '**' + df['descricao'] + '** (' + ex['dt_curta'] + ') — **Resp.: ' + df['responsavel'].astype(str) + '**'
+
+# ============================
+# PAGINAÇÃO DE LISTAS (custo de render limitado)
+# ============================
+ITENS_POR_PAGINA = 15
+
+def paginar(df, chave: str):
+    """
+    Devolve apenas a fatia da página atual (no máx. ITENS_POR_PAGINA linhas)
+    e desenha a navegação. A página fica no session_state sob 'chave'.
+    """
+    total = len(df)
+    n_paginas = max(1, -(-total // ITENS_POR_PAGINA))
+    pagina = min(st.session_state.get(chave, 0), n_paginas - 1)
+    if n_paginas > 1:
+        c_ant, c_info, c_prox = st.columns([1, 2, 1])
+        if c_ant.button("◀", key=f"{chave}_ant", disabled=pagina == 0):
+            st.session_state[chave] = pagina - 1; st.rerun()
+        inicio = pagina * ITENS_POR_PAGINA
+        c_info.caption(f"Página {pagina + 1} de {n_paginas} • itens {inicio + 1}–{min(inicio + ITENS_POR_PAGINA, total)} de {total}")
+        if c_prox.button("▶", key=f"{chave}_prox", disabled=pagina >= n_paginas - 1):
+            st.session_state[chave] = pagina + 1; st.rerun()
+    inicio = pagina * ITENS_POR_PAGINA
+    return df.iloc[inicio:inicio + ITENS_POR_PAGINA]
+
+# ============================
+# SELEÇÃO MÚLTIPLA (ações em lote)
+# ============================
+def caixa_selecao(conjunto: str, rid):
+    """
+    Checkbox de seleção de uma linha. As escolhas ficam num set no
+    session_state, então sobrevivem à troca de página da lista.
+    """
+    chave = f"{conjunto}_{rid}"
+    def alternar():
+        selecionados = st.session_state.setdefault(conjunto, set())
+        if st.session_state[chave]:
+            selecionados.add(rid)
+        else:
+            selecionados.discard(rid)
+    marcado = rid in st.session_state.get(conjunto, set())
+    st.checkbox("Selecionar", value=marcado, key=chave, on_change=alternar)
+
+def selecionados_em(conjunto: str, ids):
+    """Ids selecionados que ainda estão na lista exibida (filtros atuais)."""
+    selecionados = st.session_state.get(conjunto, set())
+    return [i for i in ids if i in selecionados]
+
+def limpar_selecao(conjunto: str):
+    st.session_state[conjunto] = set()
+    for k in [k for k in st.session_state.keys() if str(k).startswith(f"{conjunto}_")]:
+        del st.session_state[k]
 
 # ============================
 # ABAS (ordem solicitada)
@@ -483,86 +2192,69 @@ aba_resumo, aba_novo, aba_reserva, aba_negociacao, aba_metas, aba_sonhos = st.ta
 with aba_resumo:
     # Atrasados (passado)
     if not df_atrasados_passado.empty:
-        total_atrasado = df_atrasados_passado['valor'].sum()
-        with st.expander(f"⚠️ CONTAS PENDENTES DE MESES ANTERIORES: R$ {total_atrasado:,.2f}", expanded=True):
-            for _, row in df_atrasados_passado.iterrows():
+        total_atrasado = df_atrasados_passado['centavos'].sum()
+        with st.expander(f"⚠️ CONTAS PENDENTES DE MESES ANTERIORES: {formatar_moeda(total_atrasado)}", expanded=True):
+            if len(df_atrasados_passado) > 1 and st.button("✔ Pagar todas", key="pay_at_todas"):
+                atualizar_em_lote(df_atrasados_passado['id'], {"status": "Pago"}); st.rerun()
+            textos = textos_atrasados(df_atrasados_passado, hoje)
+            for rid, texto in zip(df_atrasados_passado['id'], textos):
                 col_at1, col_at2 = st.columns([3, 1])
-                dt_txt = row['data'].strftime('%d/%m/%y') if pd.notnull(row['data']) else '--/--/--'
-                col_at1.write(f"**{row['descricao']}** ({dt_txt}) — **Resp.: {row.get('responsavel','Ambos')}**")
-                if col_at2.button("✔ Pagar", key=f"pay_at_{row['id']}"):
-                    supabase.table("transacoes").update({"status": "Pago"}).eq("id", row['id']).execute()
-                    st.session_state.dados = buscar_dados(); st.rerun()
-
-    if not df_mes.empty:
-        entradas = df_mes[df_mes['tipo'] == 'Entrada']['valor'].sum()
-        saidas_pagas = df_mes[(df_mes['tipo'] == 'Saída') & (df_mes['status'] == 'Pago')]['valor'].sum()
+                col_at1.write(texto)
+                if col_at2.button("✔ Pagar", key=f"pay_at_{rid}"):
+                    atualizar_em_lote([rid], {"status": "Pago"}); st.rerun()
+
+    if not df_mes.empty or metricas_do_banco:
+        entradas = soma_cubo(ano=ano_ref, mes=mes_num, tipo='Entrada')
+        saidas_pagas = soma_cubo(ano=ano_ref, mes=mes_num, tipo='Saída', status='Pago')
         saldo_mes = entradas - saidas_pagas
 
         c1, c2, c3 = st.columns(3)
-        c1.metric("Ganhos", f"R$ {entradas:,.2f}")
-        c2.metric("Gastos (Pagos)", f"R$ {saidas_pagas:,.2f}")
-        c3.metric("Saldo Real", f"R$ {saldo_mes:,.2f}")
+        c1.metric("Ganhos", formatar_moeda(entradas))
+        c2.metric("Gastos (Pagos)", formatar_moeda(saidas_pagas))
+        c3.metric("Saldo Real", formatar_moeda(saldo_mes))
 
         if st.session_state.metas:
             with st.expander("🎯 Status das Metas"):
-                gastos_cat = df_mes[(df_mes['tipo'] == 'Saída') & (df_mes['status'] == 'Pago')].groupby('categoria')['valor'].sum()
+                gastos_cat = gastos_por_categoria(ano_ref, mes_num)
                 for cat, lim in st.session_state.metas.items():
                     if lim > 0:
                         atual = gastos_cat.get(cat, 0)
-                        st.markdown(f'<div class="meta-container"><b>{cat}</b> (R$ {atual:,.0f} / {lim:,.0f})</div>', unsafe_allow_html=True)
+                        st.markdown(f'<div class="meta-container"><b>{cat}</b> ({formatar_moeda(atual, casas=0)} / {formatar_moeda(lim, casas=0, simbolo=False)})</div>', unsafe_allow_html=True)
                         st.progress(min(atual/lim, 1.0))
 
         st.markdown("### Histórico")
-        for idx, row in df_mes.sort_values(by='data', ascending=False).iterrows():
-            valor_class = "entrada" if row['tipo'] == "Entrada" else "saida"
-            icon = row['categoria'].split()[0] if " " in row['categoria'] else "💸"
-            s_text = row.get('status', 'Pago')
-
-            if s_text == "Pago":
-                s_class = "pago"
-            elif s_text == "Pendente":
-                s_class = "pendente"
-            else:
-                s_class = "negociacao"
-
-            txt_venc = ""
-            if s_text == "Pendente" and row['tipo'] == "Saída" and pd.notnull(row['data']):
-                dias_diff = (row['data'].date() - hoje).days
-                if dias_diff < 0:
-                    txt_venc = f" <span class='vencimento-alerta'>Atrasada há {-dias_diff} dias</span>"
-                elif dias_diff == 0:
-                    txt_venc = f" <span class='vencimento-alerta' style='color:#D97706'>Vence Hoje!</span>"
-
-            resp_txt = row.get('responsavel', 'Ambos')
-            dt_card = row['data'].strftime('%d %b') if pd.notnull(row['data']) else '-- ---'
-
-            st.markdown(f"""
-              <div class="transaction-card">
-                <div class="transaction-left">
-                  <div class="card-icon">{icon}</div>
-                  <div class="tc-info">
-                    <div class="tc-title">{row["descricao"]}</div>
-                    <div class="tc-meta">{dt_card}{txt_venc}</div>
-                    <div class="tc-meta">Responsável: <b>{resp_txt}</b></div>
-                    <div class="status-badge {s_class}">{s_text}</div>
-                  </div>
-                </div>
-                <div class="transaction-right {valor_class}">R$ {row["valor"]:,.2f}</div>
-              </div>
-            """, unsafe_allow_html=True)
-
-            cp, cd = st.columns([1, 1])
-            with cp:
-                if s_text != "Pago" and st.button("✔ Pagar", key=f"pay_{row['id']}"):
-                    supabase.table("transacoes").update({"status": "Pago"}).eq("id", row['id']).execute()
-                    st.session_state.dados = buscar_dados(); st.rerun()
-            with cd:
+        if metricas_do_banco:
+            st.caption("⬇️ Os lançamentos aparecem aqui quando o histórico terminar de baixar.")
+        modo_lote_hist = st.toggle("Selecionar vários", key="lote_hist")
+        if modo_lote_hist:
+            sel_hist = selecionados_em('sel_hist', df_mes['id'])
+            b_pagar, b_excluir = st.columns(2)
+            if b_pagar.button(f"✔ Pagar selecionados ({len(sel_hist)})", disabled=not sel_hist):
+                atualizar_em_lote(sel_hist, {"status": "Pago"}); limpar_selecao('sel_hist'); st.rerun()
+            with b_excluir:
                 st.markdown('<div class="btn-excluir">', unsafe_allow_html=True)
-                if st.button("Excluir", key=f"del_{row['id']}"):
-                    supabase.table("transacoes").delete().eq("id", row['id']).execute()
-                    st.session_state.dados = buscar_dados(); st.rerun()
+                if st.button(f"Excluir selecionados ({len(sel_hist)})", disabled=not sel_hist):
+                    excluir_em_lote(sel_hist); limpar_selecao('sel_hist'); st.rerun()
                 st.markdown('</div>', unsafe_allow_html=True)
 
+        pagina_hist = paginar(df_mes.sort_values(by='data', ascending=False), f"pag_hist_{ano_ref}_{mes_num}")
+        cards_hist = html_cards_historico(pagina_hist, hoje)
+        for rid, s_text, card in zip(pagina_hist['id'], pagina_hist['status'], cards_hist):
+            st.markdown(card, unsafe_allow_html=True)
+
+            if modo_lote_hist:
+                caixa_selecao('sel_hist', rid)
+            else:
+                cp, cd = st.columns([1, 1])
+                with cp:
+                    if s_text != "Pago" and st.button("✔ Pagar", key=f"pay_{rid}"):
+                        atualizar_em_lote([rid], {"status": "Pago"}); st.rerun()
+                with cd:
+                    st.markdown('<div class="btn-excluir">', unsafe_allow_html=True)
+                    if st.button("Excluir", key=f"del_{rid}"):
+                        excluir_em_lote([rid]); st.rerun()
+                    st.markdown('</div>', unsafe_allow_html=True)
+
             st.markdown("<br>", unsafe_allow_html=True)
     else:
         st.info("Toque em 'Novo' para começar!")
@@ -571,110 +2263,170 @@ with aba_resumo:
 # ABA: NOVO (Lançamento + Fixos)
 # ============================
 with aba_novo:
-    aba_unit, aba_fixo = st.tabs(["Lançamento Único", "🗓️ Gerenciar Fixos"])
+    aba_unit, aba_fixo, aba_importar, aba_regras = st.tabs(
+        ["Lançamento Único", "🗓️ Gerenciar Fixos", "📥 Importar Extrato", "🤖 Regras"])
     with aba_unit:
         with st.form("form_novo", clear_on_submit=True):
             v = st.number_input("Valor", min_value=0.0)
             d = st.text_input("Descrição")
-            t = st.radio("Tipo", ["Saída", "Entrada"], horizontal=True)
-            stat = st.selectbox("Status", ["Pago", "Pendente", "Em Negociação"])
-            c = st.selectbox("Categoria", CATEGORIAS)
+            t = st.radio("Tipo", TIPOS, horizontal=True)
+            stat = st.selectbox("Status", STATUS)
+            c = st.selectbox("Categoria", [CATEGORIA_AUTOMATICA] + CATEGORIAS)
             resp = st.selectbox("Responsável", PESSOAS, index=idx_pessoa("Ambos", PESSOAS))
             dt = st.date_input("Data/Vencimento", date.today())
             fixo_check = st.checkbox("Salvar na lista de Fixos")
             if st.form_submit_button("Salvar"):
                 if v > 0:
-                    supabase.table("transacoes").insert({
-                        "data": str(dt), "descricao": d, "valor": v,
+                    if c == CATEGORIA_AUTOMATICA:
+                        c = categoria_automatica(d, para_centavos(v), resp)
+                    inserir_transacao({
+                        "data": str(dt), "descricao": d, "valor": em_reais(para_centavos(v)),
                         "tipo": t, "categoria": c, "status": stat,
                         "responsavel": resp
-                    }).execute()
+                    })
                     if fixo_check:
-                        supabase.table("fixos").insert({
-                            "descricao": d, "valor": v, "categoria": c,
-                            "responsavel": resp
-                        }).execute()
+                        registrar_escrita('fixos', 'insert', registros=[{
+                            "id": novo_id_provisorio(), "descricao": d, "valor": em_reais(para_centavos(v)),
+                            "categoria": c, "responsavel": resp
+                        }])
                     st.success("Cadastrado!")
-                    st.session_state.dados = buscar_dados()
-                    st.session_state.fixos = buscar_fixos()
-                    # Atualiza pessoas (caso tenha sido editado fora)
-                    st.session_state.pessoas = buscar_pessoas()
+                    if fixo_check:
+                        buscar_fixos.clear()
                     st.rerun()
                 else:
                     st.error("O valor deve ser maior que zero.")
 
     with aba_fixo:
         if not st.session_state.fixos.empty:
+            if st.button(f"🚀 Lançar todos os fixos em {mes_nome}/{ano_ref}", key="launch_todos"):
+                lancados = lancar_fixos_na_sessao(ano_ref, mes_num)
+                st.toast(f"{lancados} fixo(s) lançado(s)." if lancados else "Todos os fixos já estavam lançados neste mês.")
+                st.rerun()
             for idx, row in st.session_state.fixos.iterrows():
-                with st.expander(f"📌 {row['descricao']} - R$ {row['valor']:,.2f}"):
+                with st.expander(f"📌 {row['descricao']} - {formatar_moeda(row['centavos'])}"):
                     if st.button("Lançar neste mês", key=f"launch_{row['id']}"):
-                        d_f = str(date(ano_ref, mes_num, 1))
-                        supabase.table("transacoes").insert({
-                            "data": d_f, "descricao": row['descricao'], "valor": row['valor'],
-                            "tipo": "Saída", "categoria": row['categoria'], "status": "Pago",
-                            "responsavel": row.get('responsavel', 'Ambos')
-                        }).execute()
-                        st.session_state.dados = buscar_dados()
-                        st.toast("Lançado!")
+                        if row['id'] < 0:
+                            st.toast("Fixo ainda não salvo no banco; tente de novo em instantes.")
+                        elif lancar_fixos_na_sessao(ano_ref, mes_num, ids=[int(row['id'])]):
+                            st.toast("Lançado!")
+                        else:
+                            st.toast("Este fixo já foi lançado neste mês.")
                         st.rerun()
                     st.divider()
                     new_desc = st.text_input("Editar Descrição", value=row['descricao'], key=f"ed_d_{row['id']}")
-                    new_val = st.number_input("Editar Valor", value=float(row['valor']), key=f"ed_v_{row['id']}")
+                    new_val = st.number_input("Editar Valor", value=em_reais(row['centavos']), key=f"ed_v_{row['id']}")
                     new_resp = st.selectbox("Responsável", PESSOAS, index=idx_pessoa(row.get('responsavel', 'Ambos'), PESSOAS), key=f"ed_r_{row['id']}")
                     col_ed1, col_ed2 = st.columns(2)
                     if col_ed1.button("Salvar Alterações", key=f"save_fix_{row['id']}"):
-                        supabase.table("fixos").update({"descricao": new_desc, "valor": new_val, "responsavel": new_resp}).eq("id", row['id']).execute()
-                        st.session_state.fixos = buscar_fixos(); st.rerun()
+                        registrar_escrita('fixos', 'update', ids=[int(row['id'])], campos={"descricao": new_desc, "valor": em_reais(para_centavos(new_val)), "responsavel": new_resp})
+                        buscar_fixos.clear(); st.rerun()
                     if col_ed2.button("❌ Remover Fixo", key=f"del_fix_{row['id']}"):
-                        supabase.table("fixos").delete().eq("id", row['id']).execute()
-                        st.session_state.fixos = buscar_fixos(); st.rerun()
+                        registrar_escrita('fixos', 'delete', ids=[int(row['id'])])
+                        buscar_fixos.clear(); st.rerun()
         else:
             st.caption("Sem fixos configurados.")
 
+    with aba_importar:
+        st.caption("OFX ou CSV exportado pelo banco. Lançamentos que já existem (mesma data, valor, tipo e descrição) são ignorados.")
+        arquivo_extrato = st.file_uploader("Extrato", type=["ofx", "csv"], key="arquivo_extrato")
+        cat_imp = st.selectbox("Categoria", [CATEGORIA_AUTOMATICA] + CATEGORIAS, key="cat_importacao")
+        resp_imp = st.selectbox("Responsável", PESSOAS, index=idx_pessoa("Ambos", PESSOAS), key="resp_importacao")
+        if arquivo_extrato is not None and st.button("Importar", key="btn_importar"):
+            try:
+                with st.spinner("Importando extrato…"):
+                    importados, repetidos = importar_extrato(arquivo_extrato, resp_imp, cat_imp)
+            except (ValueError, pd.errors.ParserError) as e:
+                st.error(f"Não foi possível ler o extrato: {e}")
+            else:
+                st.toast(f"{importados} lançamento(s) importado(s); {repetidos} já existiam.")
+                st.rerun()
+
+    with aba_regras:
+        st.caption(f"Na categoria {CATEGORIA_AUTOMATICA}, vale a regra mais antiga cujo texto aparece na descrição "
+                   f"e cujos filtros batem; sem nenhuma, {CATEGORIA_PADRAO}.")
+        with st.form("form_regra", clear_on_submit=True):
+            padrao_regra = st.text_input("Texto na descrição (ex.: IFOOD, UBER)")
+            regex_regra = st.checkbox("Usar como expressão regular")
+            cat_regra = st.selectbox("Categoria", CATEGORIAS)
+            col_r1, col_r2 = st.columns(2)
+            min_regra = col_r1.number_input("Valor mínimo (0 = sem limite)", min_value=0.0)
+            max_regra = col_r2.number_input("Valor máximo (0 = sem limite)", min_value=0.0)
+            resp_regra = st.selectbox("Responsável", ["Qualquer"] + PESSOAS)
+            if st.form_submit_button("Adicionar regra"):
+                erro = validar_padrao(padrao_regra, regex_regra)
+                if erro:
+                    st.error(erro)
+                else:
+                    registrar_escrita('regras_categoria', 'insert', registros=[{
+                        "id": novo_id_provisorio(), "padrao": padrao_regra.strip(), "regex": regex_regra,
+                        "categoria": cat_regra, "valor_min": em_reais(para_centavos(min_regra)),
+                        "valor_max": em_reais(para_centavos(max_regra)),
+                        "responsavel": None if resp_regra == "Qualquer" else resp_regra,
+                    }])
+                    buscar_regras.clear(); st.rerun()
+        for regra in buscar_regras():
+            filtros = [f"a partir de {formatar_moeda(para_centavos(regra['valor_min']))}" if regra['valor_min'] else '',
+                       f"até {formatar_moeda(para_centavos(regra['valor_max']))}" if regra['valor_max'] else '',
+                       regra['responsavel'] or '']
+            col_r1, col_r2 = st.columns([5, 1])
+            col_r1.write(f"{'🔣' if regra['regex'] else '🔤'} **{regra['padrao']}** → {regra['categoria']}"
+                         + "".join(f" • {f}" for f in filtros if f))
+            if col_r2.button("🗑️", key=f"del_regra_{regra['id']}"):
+                registrar_escrita('regras_categoria', 'delete', ids=[int(regra['id'])])
+                buscar_regras.clear(); st.rerun()
+
 # ============================
 # ABA: CAIXA / RELATÓRIOS
 # ============================
 with aba_reserva:
     st.markdown(
-        f'<div class="reserva-card"><p style="margin:0;opacity:0.9;font-size:14px;">PATRIMÔNIO REAL</p><h2 style="margin:.4rem 0 0 0;">R$ {balanco:,.2f}</h2></div>',
+        f'<div class="reserva-card"><p style="margin:0;opacity:0.9;font-size:14px;">PATRIMÔNIO REAL</p><h2 style="margin:.4rem 0 0 0;">{formatar_moeda(balanco)}</h2></div>',
         unsafe_allow_html=True
     )
 
     # Resumo de Dívidas em Negociação
-    if not df_geral.empty:
-        total_negoc = df_geral[df_geral['status'] == "Em Negociação"]['valor'].sum()
-        if total_negoc > 0:
-            st.warning(f"⚠️ Você possui **R$ {total_negoc:,.2f}** em dívidas em negociação (não afetando o patrimônio real).")
+    total_negoc = soma_cubo(status="Em Negociação")
+    if total_negoc > 0:
+        st.warning(f"⚠️ Você possui **{formatar_moeda(total_negoc)}** em dívidas em negociação (não afetando o patrimônio real).")
 
     st.markdown("### 📄 Relatórios")
 
     # Recalcula o DF no momento do download (evita staleness)
+    periodo_rel = st.radio("Período do relatório", ["Mês selecionado", "Ano inteiro"], horizontal=True)
+    ano_inteiro = periodo_rel == "Ano inteiro"
+    if ano_inteiro:
+        for m in range(1, 13):
+            carregar_mes(ano_ref, m)
     if not st.session_state.dados.empty:
-        df_para_relatorio = st.session_state.dados.copy()
-        df_para_relatorio['data'] = pd.to_datetime(df_para_relatorio['data'], errors='coerce')
-        mask = (
-            (df_para_relatorio['data'].dt.month == mes_num) &
-            (df_para_relatorio['data'].dt.year == ano_ref)
-        )
-        df_para_relatorio = df_para_relatorio[mask].copy()
-        df_para_relatorio = df_para_relatorio.sort_values(by=['data', 'descricao'], na_position='last')
+        inicio_rel, fim_rel = (date(ano_ref, 1, 1), date(ano_ref + 1, 1, 1)) if ano_inteiro else (inicio_mes, fim_mes)
+        df_para_relatorio = fatia_por_data(st.session_state.dados, inicio_rel, fim_rel)
+        mes_rel = 0 if ano_inteiro else mes_num
+        nome_periodo = str(ano_ref) if ano_inteiro else mes_nome
 
         st.caption(f"🧾 Lançamentos no relatório: **{len(df_para_relatorio)}**")
 
         if not df_para_relatorio.empty:
+            # Arquivos gerados só no clique (callable) e memorizados por versão dos dados
+            cache_rel = cache_relatorios()
+            versao_rel = versao_dados(df_para_relatorio)
+            df_rel, nome_rel = df_para_relatorio, nome_periodo
             col_rel1, col_rel2 = st.columns(2)
             with col_rel1:
                 st.download_button(
                     label="📥 Baixar Excel",
-                    data=gerar_excel(df_para_relatorio),
-                    file_name=f"Financeiro_{mes_nome}.xlsx",
+                    data=lambda: relatorio_em_cache(
+                        cache_rel, ('xlsx', ano_ref, mes_rel, versao_rel), lambda: gerar_excel(df_rel)
+                    ),
+                    file_name=f"Financeiro_{nome_periodo}.xlsx",
                     mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
                 )
             with col_rel2:
                 st.download_button(
                     label="📥 Baixar PDF",
-                    data=gerar_pdf(df_para_relatorio, mes_nome),
-                    file_name=f"Financeiro_{mes_nome}.pdf",
+                    data=lambda: relatorio_em_cache(
+                        cache_rel, ('pdf', ano_ref, mes_rel, versao_rel), lambda: gerar_pdf(df_rel, nome_rel)
+                    ),
+                    file_name=f"Financeiro_{nome_periodo}.pdf",
                     mime="application/pdf"
                 )
         else:
@@ -688,18 +2440,11 @@ with aba_reserva:
 with aba_negociacao:
     st.markdown("### 🤝 Contas em Negociação")
     st.info("💡 Acompanhamento de contas no status - Em negociação.")
-    if st.session_state.dados.empty:
+    if df_geral.empty and not metricas_do_banco:
         st.info("Não há dados.")
     else:
-        df_neg = st.session_state.dados.copy()
-
-        # ✅ Garante a coluna antes de qualquer filtro (evita KeyError)
-        if 'responsavel' not in df_neg.columns:
-            df_neg['responsavel'] = 'Ambos'
-        df_neg['responsavel'] = df_neg['responsavel'].fillna('Ambos').astype(str)
-
-        # Filtra status negociação
-        df_neg = df_neg[df_neg['status'] == "Em Negociação"]
+        # Filtra status negociação (visão do snapshot, sem cópia)
+        df_neg = df_geral[df_geral['status'] == "Em Negociação"]
 
         col_f1, col_f2 = st.columns([2,1])
         resp_filtro = col_f1.selectbox("Responsável", ["Todos"] + PESSOAS, index=0)
@@ -708,66 +2453,64 @@ with aba_negociacao:
         if resp_filtro != "Todos":
             df_neg = df_neg[df_neg['responsavel'] == resp_filtro]
 
-        if somente_mes and 'data' in df_neg.columns:
-            df_neg = df_neg[
-                (df_neg['data'].dt.month == mes_num) &
-                (df_neg['data'].dt.year == ano_ref)
-            ]
+        if somente_mes:
+            df_neg = fatia_por_data(df_neg, inicio_mes, fim_mes)
 
-        if df_neg.empty:
+        por_pessoa = totais_negociacao(None if resp_filtro == "Todos" else resp_filtro,
+                                       *((ano_ref, mes_num) if somente_mes else ()))
+        if por_pessoa.empty:
             st.caption("Sem itens em negociação com os filtros atuais.")
         else:
-            total_neg = float(df_neg['valor'].sum())
-            qtd_neg = int(len(df_neg))
-            por_pessoa = df_neg.groupby('responsavel')['valor'].sum().sort_values(ascending=False)
+            total_neg = int(por_pessoa['soma'].sum())
+            qtd_neg = int(por_pessoa['qtd'].sum())
 
             m1, m2 = st.columns(2)
-            m1.metric("Total em Negociação", f"R$ {total_neg:,.2f}")
+            m1.metric("Total em Negociação", formatar_moeda(total_neg))
             m2.metric("Quantidade de Itens", str(qtd_neg))
 
             with st.expander("Ver totais por responsável", expanded=True):
-                for pessoa, soma in por_pessoa.items():
-                    st.write(f"**{pessoa}** — R$ {soma:,.2f}")
+                for pessoa, soma in por_pessoa['soma'].items():
+                    st.write(f"**{pessoa}** — {formatar_moeda(soma)}")
 
             st.markdown("#### Itens")
-            for _, row in df_neg.sort_values(by='data', ascending=False).iterrows():
-                icon = row['categoria'].split()[0] if " " in row['categoria'] else "💬"
-                dt_txt = row['data'].strftime('%d/%m/%Y') if pd.notnull(row['data']) else '--/--/----'
-                st.markdown(f"""
-                <div class="transaction-card">
-                  <div class="transaction-left">
-                    <div class="card-icon">{icon}</div>
-                    <div class="tc-info">
-                      <div class="tc-title">{row['descricao']}</div>
-                      <div class="tc-meta">{dt_txt} • <b>{row['categoria']}</b></div>
-                      <div class="status-badge negociacao">Em Negociação</div>
-                      <div class="tc-meta">Responsável: <b>{row.get('responsavel','Ambos')}</b></div>
-                    </div>
-                  </div>
-                  <div class="transaction-right saida">R$ {row['valor']:,.2f}</div>
-                </div>
-                """, unsafe_allow_html=True)
+            if metricas_do_banco:
+                st.caption("⬇️ Os itens aparecem aqui quando o histórico terminar de baixar.")
+            modo_lote_neg = st.toggle("Selecionar vários", key="lote_neg")
+            if modo_lote_neg:
+                sel_neg = selecionados_em('sel_neg', df_neg['id'])
+                b_pen, b_pago = st.columns(2)
+                if b_pen.button(f"Marcar Pendente ({len(sel_neg)})", disabled=not sel_neg):
+                    atualizar_em_lote(sel_neg, {"status": "Pendente"}); limpar_selecao('sel_neg'); st.rerun()
+                if b_pago.button(f"Marcar Pago ({len(sel_neg)})", disabled=not sel_neg):
+                    atualizar_em_lote(sel_neg, {"status": "Pago"}); limpar_selecao('sel_neg'); st.rerun()
+
+            pagina_neg = paginar(df_neg.sort_values(by='data', ascending=False), "pag_neg")
+            cards_neg = html_cards_negociacao(pagina_neg, hoje)
+            for rid, resp_atual, card in zip(pagina_neg['id'], pagina_neg['responsavel'], cards_neg):
+                st.markdown(card, unsafe_allow_html=True)
+
+                if modo_lote_neg:
+                    caixa_selecao('sel_neg', rid)
+                    st.markdown("<br>", unsafe_allow_html=True)
+                    continue
 
                 cA, cB, cC, cD = st.columns([1,1,2,1])
                 with cA:
-                    if st.button("Marcar Pendente", key=f"neg_to_pen_{row['id']}"):
-                        supabase.table("transacoes").update({"status": "Pendente"}).eq("id", row['id']).execute()
-                        st.session_state.dados = buscar_dados(); st.rerun()
+                    if st.button("Marcar Pendente", key=f"neg_to_pen_{rid}"):
+                        atualizar_em_lote([rid], {"status": "Pendente"}); st.rerun()
                 with cB:
-                    if st.button("Marcar Pago", key=f"neg_to_pago_{row['id']}"):
-                        supabase.table("transacoes").update({"status": "Pago"}).eq("id", row['id']).execute()
-                        st.session_state.dados = buscar_dados(); st.rerun()
+                    if st.button("Marcar Pago", key=f"neg_to_pago_{rid}"):
+                        atualizar_em_lote([rid], {"status": "Pago"}); st.rerun()
                 with cC:
                     novo_resp = st.selectbox(
                         "Responsável",
                         PESSOAS,
-                        index=idx_pessoa(row.get('responsavel', 'Ambos'), PESSOAS),
-                        key=f"resp_{row['id']}"
+                        index=idx_pessoa(resp_atual, PESSOAS),
+                        key=f"resp_{rid}"
                     )
                 with cD:
-                    if st.button("Salvar Resp.", key=f"save_resp_{row['id']}"):
-                        supabase.table("transacoes").update({"responsavel": novo_resp}).eq("id", row['id']).execute()
-                        st.session_state.dados = buscar_dados(); st.rerun()
+                    if st.button("Salvar Resp.", key=f"save_resp_{rid}"):
+                        atualizar_em_lote([rid], {"responsavel": novo_resp}); st.rerun()
 
                 st.markdown("<br>", unsafe_allow_html=True)
 
@@ -778,11 +2521,11 @@ with aba_metas:
     st.info("💡 Exemplo: Defina R$ 1.000,00 para '🛒 Mercado' para controlar seus gastos essenciais.")
     for cat in CATEGORIAS:
         if cat != "💰 Salário":
-            atual_m = float(st.session_state.metas.get(cat, 0))
+            atual_m = em_reais(st.session_state.metas.get(cat, 0))
             nova_meta = st.number_input(f"Meta {cat}", min_value=0.0, value=atual_m, key=f"meta_{cat}")
             if st.button(f"Atualizar {cat}", key=f"btn_meta_{cat}"):
-                supabase.table("metas").upsert({"categoria": cat, "limite": nova_meta}).execute()
-                st.session_state.metas = buscar_metas(); st.rerun()
+                registrar_escrita('metas', 'upsert', registros=[{"categoria": cat, "limite": em_reais(para_centavos(nova_meta))}])
+                buscar_metas.clear(); st.rerun()
 
 # ============================
 # ABA: SONHOS
@@ -790,11 +2533,11 @@ with aba_metas:
 with aba_sonhos:
     st.markdown("### 🎯 Calculadora de Sonhos")
     st.info("💡 Exemplo: 'Viagem de Férias' ou 'Troca de Carro'.")
-    v_sonho = st.number_input("Custo do Objetivo (R$)", min_value=0.0)
+    v_sonho = para_centavos(st.number_input("Custo do Objetivo (R$)", min_value=0.0))
     if v_sonho > 0:
         try:
-            entradas_sonho = df_mes[df_mes['tipo'] == 'Entrada']['valor'].sum()
-            saidas_sonho = df_mes[(df_mes['tipo'] == 'Saída') & (df_mes['status'] == 'Pago')]['valor'].sum()
+            entradas_sonho = soma_cubo(ano=ano_ref, mes=mes_num, tipo='Entrada')
+            saidas_sonho = soma_cubo(ano=ano_ref, mes=mes_num, tipo='Saída', status='Pago')
             sobra_m = entradas_sonho - saidas_sonho
             if sobra_m > 0:
                 m_f = int(v_sonho / sobra_m) + 1
@@ -0,0 +1,14 @@
+-- Chave de idempotência dos lançamentos inseridos pelo app: um UUID por
+-- lançamento ou, nos fixos lançados no mês, 'fixo:<id do fixo>:<AAAA-MM>'.
+-- O app envia as inserções como upsert ignorando conflitos nesta coluna:
+-- reenviar (timeout após gravar) ou relançar, de qualquer aparelho, nunca
+-- duplica. Linhas antigas ficam com a coluna nula (nulos não conflitam
+-- entre si). Sem esta migração
+-- o app segue funcionando, só sem a proteção contra repetição no banco.
+alter table public.transacoes
+    add column if not exists chave_idempotencia text;
+
+alter table public.transacoes
+    drop constraint if exists transacoes_chave_idempotencia_key;
+alter table public.transacoes
+    add constraint transacoes_chave_idempotencia_key unique (chave_idempotencia);
@@ -0,0 +1,75 @@
+-- Métricas do painel calculadas no Postgres e chamadas com supabase.rpc(...).
+-- Enquanto a réplica local baixa o histórico pela 1ª vez, as telas mostram estes
+-- números; depois o motor de sincronização os usa para conferir a réplica.
+-- Valores em centavos (bigint), como no app; status nulo conta como 'Pago' e
+-- responsável nulo como 'Ambos', igual ao cubo do app.
+
+-- Resumo mensal: as células do cubo do app (mês x categoria x tipo x status x
+-- responsável) com soma, quantidade e maior id, para o histórico inteiro.
+create or replace function public.resumo_mensal()
+returns table (data date, categoria text, tipo text, status text, responsavel text,
+               soma bigint, qtd bigint, id_max bigint)
+language sql
+stable
+as $$
+    select date_trunc('month', t.data::date)::date,
+           coalesce(t.categoria, '')::text, coalesce(t.tipo, '')::text,
+           coalesce(t.status, 'Pago')::text, coalesce(t.responsavel, 'Ambos')::text,
+           sum(round(t.valor * 100))::bigint, count(*), max(t.id)::bigint
+    from public.transacoes t
+    group by 1, 2, 3, 4, 5;
+$$;
+
+-- Saldo de todo o histórico (Patrimônio Real), total em negociação e o tamanho
+-- da tabela, numa linha.
+create or replace function public.saldo_geral()
+returns table (entradas bigint, saidas_pagas bigint, saldo bigint, em_negociacao bigint,
+               qtd bigint, id_max bigint)
+language sql
+stable
+as $$
+    select s.entradas, s.saidas_pagas, s.entradas - s.saidas_pagas, s.em_negociacao, s.qtd, s.id_max
+    from (
+        select coalesce(sum(round(t.valor * 100)) filter (where t.tipo = 'Entrada'), 0)::bigint as entradas,
+               coalesce(sum(round(t.valor * 100)) filter (
+                   where t.tipo = 'Saída' and coalesce(t.status, 'Pago') = 'Pago'), 0)::bigint as saidas_pagas,
+               coalesce(sum(round(t.valor * 100)) filter (where t.status = 'Em Negociação'), 0)::bigint as em_negociacao,
+               count(*) as qtd,
+               coalesce(max(t.id), 0)::bigint as id_max
+        from public.transacoes t
+    ) s;
+$$;
+
+-- Contas atrasadas: saídas pendentes com data anterior a p_antes, da mais antiga
+-- para a mais nova.
+create or replace function public.contas_atrasadas(p_antes date)
+returns setof public.transacoes
+language sql
+stable
+as $$
+    select *
+    from public.transacoes t
+    where t.status = 'Pendente' and t.tipo = 'Saída' and t.data::date < p_antes
+    order by t.data, t.id;
+$$;
+
+-- Totais em negociação por responsável; com p_inicio/p_fim, só as datas em
+-- [p_inicio, p_fim).
+create or replace function public.negociacao_por_responsavel(p_inicio date default null, p_fim date default null)
+returns table (responsavel text, soma bigint, qtd bigint)
+language sql
+stable
+as $$
+    select coalesce(t.responsavel, 'Ambos')::text, sum(round(t.valor * 100))::bigint, count(*)
+    from public.transacoes t
+    where t.status = 'Em Negociação'
+      and (p_inicio is null or t.data::date >= p_inicio)
+      and (p_fim is null or t.data::date < p_fim)
+    group by 1
+    order by 2 desc;
+$$;
+
+grant execute on function public.resumo_mensal() to anon, authenticated;
+grant execute on function public.saldo_geral() to anon, authenticated;
+grant execute on function public.contas_atrasadas(date) to anon, authenticated;
+grant execute on function public.negociacao_por_responsavel(date, date) to anon, authenticated;
@@ -0,0 +1,16 @@
+-- Regras de categorização automática usadas pelo app (categoria "🤖 Automática"
+-- no lançamento único e na importação de extratos). Vale a regra de menor id
+-- cujo padrão aparece na descrição; valor_min/valor_max = 0 e responsavel nulo
+-- significam "sem filtro".
+create table if not exists public.regras_categoria (
+    id bigint generated by default as identity primary key,
+    padrao text not null,
+    regex boolean not null default false,
+    categoria text not null,
+    valor_min numeric not null default 0,
+    valor_max numeric not null default 0,
+    responsavel text
+);
+
+grant select, insert, update, delete on public.regras_categoria to anon, authenticated;
+grant usage, select on sequence public.regras_categoria_id_seq to anon, authenticated;